@@ -70,6 +70,10 @@ def parse_type_line(type_line: str) -> tuple[list[str], list[str], list[str]]:
 
 
 class CardFace:
+    # Set by card.preprocessing
+    types: str
+    rules_text: str
+
     def __init__(self, scryfall_card_face, card):
         self.name = scryfall_card_face.get("name")
         self.mana_cost = scryfall_card_face.get("mana_cost") or ""
@@ -172,6 +176,21 @@ class CardProgressBar(list):
         pbar.finish()
 
 
+def stream_progress(cards):
+    """ Like CardProgressBar, for an iterable of cards whose length isn't known
+        in advance, such as a generator. """
+    widgets = [progressbar.widgets.Variable('cardname', format='{formatted_value}', width=16, precision=16), ' ',
+               progressbar.widgets.Counter(), ' cards ',
+               progressbar.widgets.Timer()]
+    pbar = progressbar.bar.ProgressBar(widgets=widgets, max_value=progressbar.UnknownLength)
+    pbar.start()
+    for i, card in enumerate(cards):
+        cardname = card.name if hasattr(card, "name") else card.get("name")
+        pbar.update(i, cardname=cardname[:16])
+        yield card
+    pbar.finish()
+
+
 ## Multiprocessing support for card-related tasks
 
 class CardProgressQueue(multiprocessing.queues.JoinableQueue):
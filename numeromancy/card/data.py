@@ -21,65 +21,197 @@
 import logging
 _logger = logging.getLogger(__name__)
 
-from .card import Card, CardProgressBar
-from .preprocessing import preprocess_all
-from .names import add_name, clear_names
+import os
+import pickle
+import re
+from collections.abc import Collection
+
+from .card import Card, CardProgressBar, stream_progress, map_multi
+from .preprocessing import preprocess_face, face_key
+from .name_index import NameIndex
+from .names import (add_name, clear_names, name_count, names_since, pop_names_since,
+                    start_lookups, stop_lookups, lookups_match)
+from numeromancy.data import is_loadable, PREPROCESS_CACHE
 
 
 _all_cards: dict[str, Card] = {}
 _cards_by_sets: dict[str, set[str]] = {}
-
-def is_loadable(scryfall_card):
-    return scryfall_card["legalities"]["vintage"] in ("legal", "restricted") and \
-        scryfall_card["layout"] not in ("reversible_card")
-
-def load_cards(scryfall_cards):
-    """ Loads the cards' informations from scryfall into the module. """
+_name_index: NameIndex | None = None
+# Views built by get_cards and get_set, until the cards are loaded again
+_format_views: dict[str, frozenset[Card]] = {}
+_set_views: dict[str, frozenset[Card]] = {}
+
+def _load_preprocess_cache(cache_file) -> dict:
+    if not cache_file or not os.path.exists(cache_file):
+        return {}
+    with open(cache_file, 'rb') as f:
+        cache = pickle.load(f)
+    return cache.get('faces', {})
+
+
+def _save_preprocess_cache(cache_file, cache: dict) -> None:
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(cache_file + ".tmp", 'wb') as f:
+        pickle.dump({'faces': cache}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(cache_file + ".tmp", cache_file)
+
+
+def _preprocess_face(face) -> tuple:
+    """ Preprocesses a face, and returns its cache entry. """
+    count = name_count()
+    start_lookups()
+    try:
+        preprocess_face(face)
+    finally:
+        lookups = stop_lookups()
+    return face.types, face.rules_text, names_since(count), lookups
+
+
+def _preprocess_cached(card: Card, cache: dict, fresh: dict) -> None:
+    """ Preprocesses the card's faces, reusing the cached results of unchanged faces.
+        Cache entries also hold the names a face added to the name registry,
+        which are registered again so the registry ends up the same, and the names
+        its preprocessing looked up in the registry. An entry is only reused while
+        those names are registered as they were, so adding or removing other
+        card names doesn't invalidate it. """
+    for face in card.card_faces:
+        key = face_key(face)
+        entry = cache.get(key)
+        if entry is None or not lookups_match(entry[3]):
+            entry = _preprocess_face(face)
+        else:
+            face.types, face.rules_text, added, _ = entry
+            for name in added:
+                add_name(name)
+        fresh[key] = entry
+
+
+def _preprocess_card(card: Card):
+    """ Preprocesses a card in a worker process. Names the card adds to the
+        name registry are removed again so they can't leak into the next card,
+        and returned so the parent process can tell which cards depend on them. """
+    count = name_count()
+    entries = [_preprocess_face(f) for f in card.card_faces]
+    added = pop_names_since(count)
+    return card.name, entries, added
+
+
+def _mentions(tokens):
+    return re.compile('|'.join(re.escape(t) for t in tokens)) if tokens else None
+
+
+def _preprocess_parallel(cards: list[Card], cache: dict, fresh: dict, processes=None):
+    """ Preprocesses the cards across processes, with the same result as
+        preprocessing them serially in order. """
+    # Cached cards are cheap, and are applied below in card order so that the names
+    # they register are only seen by the cards after them, as in a serial run
+    misses = [card for card in cards if not all(face_key(f) in cache for f in card.card_faces)]
+    missed = {card.name for card in misses}
+    results = {name: (entries, added) for name, entries, added in map_multi(_preprocess_card, misses, processes)}
+    tokens = {name for _, added in results.values() for name in added}
+    tokens.update(name for card in cards if card.name not in missed
+                  for f in card.card_faces for name in cache[face_key(f)][2])
+    mentions = _mentions(tokens)
+    # In a serial run, names found in a card's text (i.e. token names) are registered
+    # and seen by every later card. Cards that found such names, or that mention them,
+    # are redone here in the original order so they see the same registry as they
+    # would have serially, which also leaves the registry identical.
+    for card in CardProgressBar(cards):
+        count = name_count()
+        if card.name not in missed:
+            _preprocess_cached(card, cache, fresh)
+        else:
+            entries, added = results.get(card.name, (None, ()))
+            if entries is None or added or (mentions and any(mentions.search(f.oracle_text) for f in card.card_faces)):
+                _preprocess_cached(card, {}, fresh)
+            else:
+                for f, entry in zip(card.card_faces, entries):
+                    f.types, f.rules_text, _, _ = entry
+                    fresh[face_key(f)] = entry
+        # Cards preprocessed again here may register names the workers didn't find
+        new = set(names_since(count)) - tokens
+        if new:
+            tokens |= new
+            mentions = _mentions(tokens)
+
+
+def load_cards(scryfall_cards, parallel=False, processes=None, cache_file=PREPROCESS_CACHE):
+    """ Loads the cards' informations from scryfall into the module.
+        Cards from the card store list every set they were printed in under "sets".
+        scryfall_cards may also be a generator such as data.stream, which is
+        consumed one card at a time.
+        If parallel is set, the cards are preprocessed across processes
+        (the number of CPUs, unless processes is given).
+        Preprocessed texts are cached in cache_file, so only new or changed
+        faces, or faces whose text would now resolve names differently, are
+        preprocessed again. Set it to None to disable the cache. """
+    global _name_index
     _all_cards.clear()
     _cards_by_sets.clear()
+    _name_index = None
+    _format_views.clear()
+    _set_views.clear()
 
     _logger.info("Loading cards from scryfall data...")
     clear_names()
-    for sc in CardProgressBar(scryfall_cards):
+    if isinstance(scryfall_cards, Collection):
+        scryfall_cards = CardProgressBar(scryfall_cards)
+    else:
+        scryfall_cards = stream_progress(scryfall_cards)
+    for sc in scryfall_cards:
         if is_loadable(sc):
             name = sc["name"]
-            card_set = sc["set"].upper()
-            if name not in _all_cards:
-                card = Card(sc)
-                _all_cards[name] = card
-                add_name(name)
-            else:
-                _all_cards[name].sets.add(card_set)
-
-            if card_set not in _cards_by_sets:
-                _cards_by_sets[card_set] = {name}
-            else:
-                _cards_by_sets[card_set].add(name)
+            for card_set in sc.get("sets", (sc["set"],)):
+                card_set = card_set.upper()
+                if name not in _all_cards:
+                    card = Card(sc)
+                    _all_cards[name] = card
+                    add_name(name)
+                else:
+                    _all_cards[name].sets.add(card_set)
+
+                if card_set not in _cards_by_sets:
+                    _cards_by_sets[card_set] = {name}
+                else:
+                    _cards_by_sets[card_set].add(name)
 
     _logger.info("Preprocessing card texts...")
-    for card in CardProgressBar(_all_cards.values()):
-        preprocess_all(card)
+    cache = _load_preprocess_cache(cache_file)
+    # Only the entries of the current faces are kept, dropping stale ones
+    fresh = {}
+    if parallel:
+        _preprocess_parallel(list(_all_cards.values()), cache, fresh, processes)
+    else:
+        for card in CardProgressBar(_all_cards.values()):
+            _preprocess_cached(card, cache, fresh)
+    if cache_file and fresh != cache:
+        _save_preprocess_cache(cache_file, fresh)
 
 
-def get_cards(format="vintage") -> set[Card]:
-    """ Returns a set of all the Cards loaded by the function load_cards. """
-    return set(c for c in _all_cards.values() if c.legalities[format] in ("legal", "restricted"))
+def get_cards(format="vintage") -> frozenset[Card]:
+    """ Returns a set of all the Cards loaded by the function load_cards
+        that are legal in the format. The set is built once per load_cards. """
+    view = _format_views.get(format)
+    if view is None:
+        view = frozenset(c for c in _all_cards.values() if c.legalities[format] in ("legal", "restricted"))
+        _format_views[format] = view
+    return view
+
+
+def get_name_index() -> NameIndex:
+    """ Returns the index find_name searches, building it if the cards were loaded since.
+        Build it before forking worker processes so that they share it. """
+    global _name_index
+    if _name_index is None:
+        _name_index = NameIndex(_all_cards)
+    return _name_index
 
 
 def find_name(cardname: str) -> str:
     """ Find the closest card name. Useful for i.e. referring to only one half of a DFC.
-        Error if multiple matched unless it is an exact match. """
-    names = [name for name in _all_cards if cardname in name]
-    if len(names) == 1:
-        return names[0]
-    elif len(names) > 1:
-        names = [name for name in names if _all_cards[name].card_faces[0].name == cardname]
-        if len(names) == 1:
-            return names[0]
-        else:
-            raise KeyError(f"{cardname} matches multiple card names.")
-    else:
-        raise KeyError(f"{cardname} doesn't match any known card names.")
+        Error if multiple matched unless it is an exact match.
+        Names that match nothing are retried ignoring case, accents and punctuation. """
+    return get_name_index().find(cardname)
 
 
 def get_card(cardname: str) -> Card:
@@ -87,9 +219,11 @@ def get_card(cardname: str) -> Card:
     return _all_cards[cardname]
 
 
-def get_set(setcode: str) -> set[Card]:
-    """ Returns a set of all the Cards in the given set. """
+def get_set(setcode: str) -> frozenset[Card]:
+    """ Returns a set of all the Cards in the given set. The set is built once per load_cards. """
     setcode = setcode.upper()
-    if setcode not in _cards_by_sets:
-        return set()
-    return {get_card(cardname) for cardname in _cards_by_sets[setcode]}
+    view = _set_views.get(setcode)
+    if view is None:
+        view = frozenset(get_card(cardname) for cardname in _cards_by_sets.get(setcode, ()))
+        _set_views[setcode] = view
+    return view
@@ -0,0 +1,109 @@
+# This file is part of Demystify.
+#
+# Demystify: a Magic: The Gathering parser
+# Copyright (C) 2022 Ada Joule
+#
+# Demystify is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 3 of the License,
+# or (at your option) any later version.
+#
+# Demystify is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Demystify.  If not, see <http://www.gnu.org/licenses/>.
+
+"""card.name_index -- Fast exact and partial card name lookup"""
+
+import re
+import unicodedata
+from collections import defaultdict
+from collections.abc import Mapping
+
+from .card import Card
+
+
+_punctuation = re.compile(r"[^\w\s]", flags=re.UNICODE)
+def normalize_name(name: str) -> str:
+    """ Case, accent and punctuation insensitive form of a name,
+        e.g. "Lim-Dûl's Vault" becomes "limduls vault". """
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(ch for ch in name if not unicodedata.combining(ch))
+    return ' '.join(_punctuation.sub('', name.casefold()).split())
+
+
+def _trigrams(s: str) -> set[str]:
+    return {s[i:i+3] for i in range(len(s) - 2)}
+
+
+class NameIndex:
+    """ Answers card.find_name queries without scanning every card name.
+
+        A query resolves to, in order:
+        - the card whose front face has exactly that name,
+        - the only card whose full name contains the query,
+          found through a trigram index of the full names,
+        - the only card with a full or face name equal to the query
+          after normalize_name. """
+
+    def __init__(self, cards: Mapping[str, Card]):
+        self.names = list(cards)
+        self.front = defaultdict(list)
+        self.normalized = defaultdict(set)
+        self.trigrams = defaultdict(list)
+        for i, (name, card) in enumerate(cards.items()):
+            self.front[card.card_faces[0].name].append(name)
+            self.normalized[normalize_name(name)].add(name)
+            for face in card.card_faces:
+                self.normalized[normalize_name(face.name)].add(name)
+            for t in _trigrams(name):
+                self.trigrams[t].append(i)
+        self._found: dict[str, str | KeyError] = {}
+
+    def containing(self, cardname: str, limit: int = 2) -> list[str]:
+        """ Returns up to limit card names which contain cardname. """
+        if len(cardname) < 3:
+            candidates = range(len(self.names))
+        else:
+            postings = [self.trigrams.get(t, ()) for t in _trigrams(cardname)]
+            candidates = min(postings, key=len)
+        matches = []
+        for i in candidates:
+            if cardname in self.names[i]:
+                matches.append(self.names[i])
+                if len(matches) >= limit:
+                    break
+        return matches
+
+    def _find(self, cardname: str) -> str:
+        front = self.front.get(cardname, ())
+        if len(front) == 1:
+            return front[0]
+        matches = self.containing(cardname)
+        if len(matches) == 1:
+            return matches[0]
+        elif len(matches) > 1:
+            raise KeyError(f"{cardname} matches multiple card names.")
+        normalized = self.normalized.get(normalize_name(cardname), ())
+        if len(normalized) == 1:
+            return next(iter(normalized))
+        elif len(normalized) > 1:
+            raise KeyError(f"{cardname} matches multiple card names.")
+        raise KeyError(f"{cardname} doesn't match any known card names.")
+
+    def find(self, cardname: str) -> str:
+        """ Returns the card name matching cardname, raising KeyError
+            if there are none or several. Results are memoized. """
+        found = self._found.get(cardname)
+        if found is None:
+            try:
+                found = self._find(cardname)
+            except KeyError as e:
+                found = e
+            self._found[cardname] = found
+        if isinstance(found, KeyError):
+            raise KeyError(*found.args)
+        return found
@@ -20,6 +20,7 @@
 
 import re
 from collections.abc import Iterable, Sequence
+from itertools import islice
 
 import logging
 _logger = logging.getLogger(__name__)
@@ -46,6 +47,51 @@ def clear_names():
     _uname_from_name.clear()
     _name_from_uname.clear()
 
+def name_count() -> int:
+    return len(_uname_from_name)
+
+def names_since(count: int) -> list[str]:
+    """ Returns the names added since the registry held count names,
+        in the order they were added. """
+    names = list(islice(reversed(_uname_from_name), len(_uname_from_name) - count))
+    names.reverse()
+    return names
+
+def pop_names_since(count: int) -> list[str]:
+    """ Removes the names added since the registry held count names,
+        and returns them in the order they were added. """
+    names = names_since(count)
+    for name in names:
+        del _name_from_uname[_uname_from_name.pop(name)]
+    return names
+
+# The names looked up by is_registered since start_lookups, and whether they were registered
+_lookups: dict[str, bool] | None = None
+
+def is_registered(name: str) -> bool:
+    registered = name in _uname_from_name
+    if _lookups is not None:
+        _lookups.setdefault(name, registered)
+    return registered
+
+def start_lookups():
+    """ Starts recording the names looked up in the registry. Which of them are
+        registered is all the preprocessed text depends on in the registry. """
+    global _lookups
+    _lookups = {}
+
+def stop_lookups() -> dict[str, bool]:
+    """ Stops recording, and returns the names looked up since start_lookups,
+        each with whether it was registered when first looked up. """
+    global _lookups
+    lookups = _lookups or {}
+    _lookups = None
+    return lookups
+
+def lookups_match(lookups: dict[str, bool]) -> bool:
+    """ Whether the recorded names would be looked up the same now. """
+    return all((name in _uname_from_name) == registered for name, registered in lookups.items())
+
 
 # Handle any Legendary names we couldn't get with ", " or " the ", most of
 # which have two words only, eg. Arcades Sabboth, or "of the".
@@ -174,7 +220,7 @@ def format_by_name(text: str, names: Sequence[str]) -> str:
     """ Replaces all of the card names in text by its uname counterpart. """
     words = text.split()
     for name in names:
-        if name not in _uname_from_name:
+        if not is_registered(name):
             _logger.info(f"Found token name: {name}")
             _logger.debug(f"From card text {str}")
             add_name(name)
@@ -218,7 +264,7 @@ def preprocess_names(line, selfnames=(), parentnames=()):
             good = []
             bad = []
             for names in potential_names(text, selfnames):
-                if all((name in _uname_from_name for name in names)):
+                if all((is_registered(name) for name in names)):
                     good += [names]
                 else:
                     bad += [names]
@@ -18,6 +18,7 @@
 
 """card.preprocessing -- Card text preprocessing"""
 
+import hashlib
 import re
 
 from .card import Card, CardFace
@@ -102,6 +103,19 @@ def preprocess_face(card_face: CardFace):
     card_face.rules_text = preprocess_rulestext(card_face.oracle_text, names)
 
 
+# Bump whenever a change to the preprocessing would change its output,
+# so that cached results are recomputed.
+PREPROCESS_VERSION = 2
+
+def face_key(card_face: CardFace) -> str:
+    """ The key of a face's preprocessed text in the preprocessing cache. """
+    h = hashlib.sha1()
+    for s in (str(PREPROCESS_VERSION), card_face.name, card_face.oracle_text, card_face.type_line):
+        h.update(s.encode('UTF8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
 ## Main entry point for the preprocessing step ##
 def preprocess_all(card: Card):
     for f in card.card_faces:
@@ -0,0 +1,152 @@
+""" card_pool - Card attributes and candidate pools for deck generation """
+
+from datetime import datetime
+
+import numpy as np
+
+import numeromancy.card as card
+from numeromancy.format import get_legal_cards
+
+
+def card_group(card):
+    # 0 = creature
+    # 1 = noncreature
+    # 2 = land
+    layout = card.layout
+    faces = card.card_faces
+    if layout in ['split', 'modal_dfc', 'adventure']:
+        if "Creature" in faces[0].cardtypes or "Creature" in faces[1].cardtypes:
+            return 0
+        elif "Land" in faces[0].cardtypes and "Land" in faces[1].cardtypes:
+            # Yes, "and", we only returns land if both faces are lands
+            return 2
+        else:
+            return 1
+    else:
+        if "Creature" in faces[0].cardtypes:
+            return 0
+        elif "Land" in faces[0].cardtypes:
+            return 2
+        else:
+            return 1
+
+
+def is_nonland(c: card.Card) -> bool:
+    front = "Land" not in c.card_faces[0].cardtypes
+    back = False
+    if not front and c.layout in ['split', 'modal_dfc', 'adventure']:
+        back = "Land" not in c.card_faces[1].cardtypes
+    return front or back
+
+
+PRIMARY_COLORS = ["W", "U", "B", "R", "G", "C"]
+def has_mana_color(symbol, colors):
+    return all(s not in PRIMARY_COLORS or s in colors for s in symbol.split('/'))
+
+
+def is_in_color(c: card.Card, colors: list[str]) -> bool:
+    # Handle adventure lands differently because scryfall decides to put mana cost on the wrong half
+    # Remove when fixed
+    if c.layout == "adventure" and "Land" in c.card_faces[0].cardtypes:
+        mana = c.card_faces[0].mana_cost.strip('{}').split('}{')
+        return all(has_mana_color(m, colors) for m in mana)
+    if c.layout == "meld" and c.card_faces[0].mana_cost == "":
+        return False
+    for f in c.card_faces:
+        if c.layout in ["transform", "flip", "battle"] and f == c.card_faces[1]:
+            continue
+        if "Land" not in f.cardtypes:
+            mana = f.mana_cost.strip('{}').split('}{')
+            if all(has_mana_color(m, colors) for m in mana):
+                return True
+    return False
+
+
+def mana_color_mask(mana_cost: str) -> int:
+    """ Bit mask of the PRIMARY_COLORS a mana cost needs, as judged by has_mana_color. """
+    mask = 0
+    for symbol in mana_cost.strip('{}').split('}{'):
+        for s in symbol.split('/'):
+            if s in PRIMARY_COLORS:
+                mask |= 1 << PRIMARY_COLORS.index(s)
+    return mask
+
+
+def colors_mask(colors) -> int:
+    return sum(1 << i for i, s in enumerate(PRIMARY_COLORS) if s in colors)
+
+
+# No colors mask contains this bit, so a face with this requirement is never in color
+_NEVER = 1 << len(PRIMARY_COLORS)
+
+def color_requirements(c: card.Card) -> tuple[int, int]:
+    """ The color masks of the card's two castable faces, following is_in_color:
+        the card is in color if either mask is a subset of the colors. """
+    if c.layout == "adventure" and "Land" in c.card_faces[0].cardtypes:
+        return mana_color_mask(c.card_faces[0].mana_cost), _NEVER
+    if c.layout == "meld" and c.card_faces[0].mana_cost == "":
+        return _NEVER, _NEVER
+    masks = [mana_color_mask(f.mana_cost) for f in c.card_faces
+             if not (c.layout in ["transform", "flip", "battle"] and f == c.card_faces[1])
+             and "Land" not in f.cardtypes]
+    masks += 2 * [_NEVER]
+    return masks[0], masks[1]
+
+
+class CardIndex:
+    """ Card attributes over a dense card id space, so that candidate pools can be
+        built by intersecting boolean arrays instead of testing every card.
+        Card i is cards[i], and every mask is a boolean array indexed by card id. """
+
+    def __init__(self, cards):
+        self.cards = sorted(cards, key=lambda c: c.name)
+        self.ids = {c.name: i for i, c in enumerate(self.cards)}
+        self.nonland = np.array([is_nonland(c) for c in self.cards], dtype=bool)
+        self.group = np.array([card_group(c) for c in self.cards], dtype=np.int8)
+        self.requirements = np.array([color_requirements(c) for c in self.cards], dtype=np.int16).reshape(-1, 2)
+        self._legal: dict[tuple, np.ndarray] = {}
+        self._in_color: dict[int, np.ndarray] = {}
+
+    def legal(self, format: str) -> np.ndarray:
+        """ Cards currently legal in the format according to Scryfall. """
+        key = (format,)
+        if key not in self._legal:
+            self._legal[key] = np.array([c.legalities.get(format) == "legal" for c in self.cards], dtype=bool)
+        return self._legal[key]
+
+    def legal_at(self, format: str, date_or_code: str|datetime) -> np.ndarray:
+        """ Cards legal in the format at the date or release of the set. """
+        key = (format, date_or_code)
+        if key not in self._legal:
+            mask = np.zeros(len(self.cards), dtype=bool)
+            mask[[self.ids[c.name] for c in get_legal_cards(format, date_or_code) if c.name in self.ids]] = True
+            self._legal[key] = mask
+        return self._legal[key]
+
+    def in_color(self, colors) -> np.ndarray:
+        """ Cards castable with the given colors, as judged by is_in_color. """
+        mask = colors_mask(colors)
+        if mask not in self._in_color:
+            self._in_color[mask] = ((self.requirements & ~mask) == 0).any(axis=1)
+        return self._in_color[mask]
+
+    def select(self, mask: np.ndarray) -> set[card.Card]:
+        """ Returns the cards selected by a boolean mask. """
+        return {self.cards[i] for i in np.flatnonzero(mask)}
+
+    def candidates(self, legal: np.ndarray, colors) -> set[card.Card]:
+        """ Nonland cards among the legal ones that are in the given colors. """
+        return self.select(legal & self.nonland & self.in_color(colors))
+
+
+_index: CardIndex | None = None
+_indexed = None
+
+def get_index() -> CardIndex:
+    """ Returns the index of the loaded cards, building it again if they were reloaded. """
+    global _index, _indexed
+    cards = card.get_cards()
+    if _index is None or _indexed is not cards:
+        _index = CardIndex(cards)
+        _indexed = cards
+    return _index
@@ -22,6 +22,8 @@ import datetime
 import json
 import logging
 import os
+import pickle
+import re
 import time
 import urllib.request
 import urllib.error
@@ -37,6 +39,8 @@ CACHEDIR = os.path.join(DATADIR, "cache")
 DEFAULT_CARDS_JSON = "scryfall-default-cards.json"
 JSONCACHE = os.path.join(CACHEDIR, DEFAULT_CARDS_JSON)
 METADATA = os.path.join(CACHEDIR, "scryfall.metadata")
+CARDSTORE = os.path.join(CACHEDIR, "cards.pickle")
+PREPROCESS_CACHE = os.path.join(CACHEDIR, "preprocessed.pickle")
 
 ## Scryfall Client ##
 
@@ -140,16 +144,180 @@ def maybe_download(filename=JSONCACHE):
               .format(m2["size"], metadata["size"]))
     return download(filename, metadata)
 
+## Card store ##
+
+# Only the fields read by card.Card and card.CardFace are kept in the store.
+CARD_FIELDS = ("name", "layout", "legalities", "colors", "set", "card_faces",
+               "mana_cost", "type_line", "oracle_text",
+               "power", "toughness", "loyalty", "defense")
+FACE_FIELDS = ("name", "mana_cost", "colors", "type_line", "oracle_text",
+               "power", "toughness", "loyalty", "defense")
+
+def is_loadable(scryfall_card):
+    return scryfall_card["legalities"]["vintage"] in ("legal", "restricted") and \
+        scryfall_card["layout"] not in ("reversible_card")
+
+def project(scryfall_card):
+    """ Strip a Scryfall card object down to the fields used by card.Card. """
+    sc = {k: scryfall_card[k] for k in CARD_FIELDS if k in scryfall_card}
+    if "card_faces" in sc:
+        sc["card_faces"] = [{k: face[k] for k in FACE_FIELDS if k in face}
+                            for face in sc["card_faces"]]
+    return sc
+
+def _source_signature(filename):
+    """ Identifies the JSON file a store was built from. """
+    return {
+        "metadata": load_cached_metadata(),
+        "size": os.path.getsize(filename),
+        "mtime": os.path.getmtime(filename),
+    }
+
+def _to_columns(cards):
+    """ Lay out the stored cards column-wise: one list per card field, the number of
+        faces of each card, and one list per face field holding the faces of every card
+        back to back. Cards sharing the same legalities share a single dict, which
+        is pickled once. """
+    legalities = {}
+    columns = {k: [] for k in CARD_FIELDS + ("sets",) if k != "card_faces"}
+    face_counts = []
+    faces = {k: [] for k in FACE_FIELDS}
+    for sc in cards:
+        for k, column in columns.items():
+            value = sc.get(k)
+            if k == "legalities" and value is not None:
+                value = legalities.setdefault(tuple(sorted(value.items())), value)
+            column.append(value)
+        card_faces = sc.get("card_faces", ())
+        face_counts.append(len(card_faces))
+        for face in card_faces:
+            for k, column in faces.items():
+                column.append(face.get(k))
+    return {"count": len(cards), "cards": columns, "face_counts": face_counts, "faces": faces}
+
+def _from_columns(columns):
+    """ Rebuild the card dicts laid out by _to_columns. Missing fields come back as None,
+        which card.Card reads the same way. """
+    fields = list(columns["cards"])
+    face_fields = list(columns["faces"])
+    face_rows = zip(*columns["faces"].values())
+    cards = []
+    for row, face_count in zip(zip(*columns["cards"].values()), columns["face_counts"]):
+        sc = dict(zip(fields, row))
+        if face_count:
+            sc["card_faces"] = [dict(zip(face_fields, next(face_rows))) for _ in range(face_count)]
+        cards.append(sc)
+    return cards
+
+def build_store(scryfall_cards, filename=JSONCACHE, store=CARDSTORE):
+    """ Convert the Scryfall cards into the compact card store, deduplicated by name.
+        Each card keeps the fields of its first printing, and the codes of every set
+        it was printed in under "sets". The fields are stored column-wise (see
+        _to_columns). Returns the stored cards. """
+    cards = {}
+    for sc in scryfall_cards:
+        if not is_loadable(sc):
+            continue
+        name = sc["name"]
+        if name not in cards:
+            cards[name] = project(sc)
+            cards[name]["sets"] = [sc["set"]]
+        elif sc["set"] not in cards[name]["sets"]:
+            cards[name]["sets"].append(sc["set"])
+    cards = list(cards.values())
+    os.makedirs(os.path.dirname(store), exist_ok=True)
+    with open(store + ".tmp", 'wb') as f:
+        pickle.dump({"source": _source_signature(filename), "columns": _to_columns(cards)},
+                    f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(store + ".tmp", store)
+    _logger.debug(f"Stored {len(cards)} cards in {store}.")
+    return cards
+
+def load_store(filename=JSONCACHE, store=CARDSTORE):
+    """ Load the cards from the card store, or return None if the store
+        is missing, in an older layout, or was built from a different JSON file. """
+    if not os.path.exists(store):
+        return None
+    with open(store, 'rb') as f:
+        s = pickle.load(f)
+    if "columns" not in s or s["source"] != _source_signature(filename):
+        _logger.info("Card store is out of date.")
+        return None
+    _logger.debug(f"Loaded {s['columns']['count']} cards from {store}.")
+    return _from_columns(s["columns"])
+
+## Streaming loader ##
+
+_separator = re.compile(r'[\s,]*')
+
+def iter_json_array(f, chunk_size=1 << 20):
+    """ Incrementally parse a JSON array of objects from a text file,
+        yielding one element at a time without reading the whole file. """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    started = False
+    while True:
+        # The separator pattern matches anywhere, if only the empty string
+        skipped = _separator.match(buf, pos)
+        if skipped:
+            pos = skipped.end()
+        if pos < len(buf) and buf[pos] == ']':
+            return
+        if pos < len(buf) and not started:
+            if buf[pos] != '[':
+                raise ValueError("Expected a JSON array.")
+            started = True
+            pos += 1
+            continue
+        if pos < len(buf):
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+                # An element ending exactly at the end of the buffer may be cut short
+                if end < len(buf) or eof:
+                    yield obj
+                    pos = end
+                    continue
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+        elif eof:
+            raise ValueError("Unterminated JSON array.")
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buf = buf[pos:] + chunk
+        pos = 0
+
+def stream(filename=JSONCACHE):
+    """ Stream the loadable cards from the Scryfall JSON file one at a time,
+        keeping only the fields used by card.Card. """
+    with open(filename) as f:
+        for sc in iter_json_array(f):
+            if is_loadable(sc):
+                yield project(sc)
+
 ## Loader ##
 
-def load(filename=JSONCACHE, no_download=False):
-    """ Load the cards from the Scryfall Oracle JSON file. """
+def load(filename=JSONCACHE, no_download=False, store=CARDSTORE, streaming=False):
+    """ Load the cards from the Scryfall Oracle JSON file.
+        If store is given, the cards are read from the compact card store instead,
+        which is (re)built from the JSON file whenever that changes.
+        If streaming is set, returns a generator over the JSON file instead
+        (see stream), bypassing the store. """
     if no_download or not maybe_download(filename):
         if os.path.exists(filename):
             print("Falling back to existing JSON file.")
         else:
             _logger.critical("Failed to get JSON file.")
             return {}
+    if streaming:
+        return stream(filename)
+    if store:
+        cards = load_store(filename, store)
+        if cards is not None:
+            return cards
+        return build_store(stream(filename), filename, store)
     with open(filename) as f:
         j = json.load(f)
     _logger.debug(f"Loaded {len(j)} objects from {filename}.")
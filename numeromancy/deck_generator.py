@@ -11,10 +11,12 @@ import sys
 import numeromancy.card as card
 import numeromancy.data as data
 import numeromancy.util as util
-from numeromancy.model import cost_model, synergy_model, EmbeddedCardDataset, SynergyDataset
+from numeromancy.model import cost_model, synergy_model, EmbeddedCardDataset, EmbeddingStore
 from numeromancy.train_synergy import load_trained_synergy
 from numeromancy.format import get_legal_cards, UNLIMITED, date_and_code, find_previous_set
 from numeromancy.preprocessing import CARD_TEXTS, props_vector, read_text
+from numeromancy.synergy_matrix import load_synergy_matrix
+from numeromancy.card_pool import PRIMARY_COLORS, card_group, get_index, has_mana_color, is_in_color, is_nonland
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -36,7 +38,7 @@ def normalize(matrix):
 
 COST_EFF_MATRIX: dict[str, float] = {}
 SYNERGY_MODEL = None
-EMBEDDINGS = {}
+EMBEDDINGS: EmbeddingStore | None = None
 def init_cost_effectiveness_matrix(legal_cards):
     global COST_EFF_MATRIX
     global EMBEDDINGS
@@ -44,12 +46,10 @@ def init_cost_effectiveness_matrix(legal_cards):
     face_names = [f.name for c in legal_cards for f in c.card_faces if "Land" not in f.cardtypes]
     _, clf = cost_model.load_model()
     cv = props_vector(legal_cards, props=['cmc'])
-    dataset = [(EMBEDDINGS[name], min(int(cv[name].item()), 7)) for name in face_names]
-    dataset = util.transpose(dataset)
+    y = [min(int(cv[name].item()), 7) for name in face_names]
     data_loader = DataLoader(
-        EmbeddedCardDataset(dataset[0], dataset[1]),
+        EmbeddedCardDataset(EMBEDDINGS.gather(face_names), y),
         batch_size=2048)
-    y = dataset[1]
     y_preds = []
     with torch.no_grad():
         for emb, _ in progressbar(data_loader):
@@ -82,23 +82,76 @@ def init_synergy_model(set_code=None):
         SYNERGY_MODEL = synergy_model.load_model()
 
 
+def embedding_name(c: card.Card) -> str:
+    """ The name the card's embedding is stored under, i.e. its front face. """
+    return c.name.split('//')[0].strip()
+
+
+def stack_embeddings(cards) -> torch.Tensor:
+    """ Stack the embeddings of the given cards into one matrix, one row per card. """
+    global EMBEDDINGS
+    if EMBEDDINGS is None:
+        raise RuntimeError("Card embeddings not loaded, call init_cost_effectiveness_matrix first")
+    return EMBEDDINGS.gather([embedding_name(c) for c in cards]).to(device)
+
+
 def compute_synergy_matrix(deck, legal_cards):
     global SYNERGY_MODEL
-    global EMBEDDINGS
-    matrix = {}
-    clf = SYNERGY_MODEL
-    for c1 in progressbar(legal_cards):
-        c1name = c1.name.split('//')[0].strip()
-        dataset = [(EMBEDDINGS[c1name], EMBEDDINGS[c2.name.split('//')[0].strip()], 1) for c2 in deck]
-        dataset = util.transpose(dataset)
-        data_loader = DataLoader(SynergyDataset(dataset[0], dataset[1], dataset[2]), batch_size=128)
-        sum_score = 0.0
-        with torch.no_grad():
-            for emb1, emb2, _ in data_loader:
-                logits = clf(torch.cat((emb1, emb2), dim=1).to(device))
-                sum_score += sum(logits)
-        matrix[c1.name] = sum_score/len(deck)
-    return matrix
+    legal_cards = list(legal_cards)
+    # Copies of the same card score the same, so score each distinct card once
+    # and weight it by the number of copies in the deck
+    counts = Counter(c.name for c in deck)
+    partners = {c.name: c for c in deck}
+    weights = torch.tensor([float(counts[name]) for name in partners], device=device)
+    scores = synergy_model.score_synergy(SYNERGY_MODEL, stack_embeddings(legal_cards), stack_embeddings(partners.values()))
+    mean_scores = (scores @ weights / len(deck)).tolist()
+    return {c.name: s for c, s in zip(legal_cards, mean_scores)}
+
+
+class SynergyAccumulator:
+    """ Keeps the running synergy sum of every candidate card against a growing deck,
+        so that adding a card only scores that one card against the candidates
+        instead of rescoring every candidate against the whole deck.
+        If a precomputed SynergyMatrix covering the candidates is given,
+        scores are looked up from it instead of running the synergy model. """
+
+    def __init__(self, candidates, deck=(), pairwise=None):
+        self.candidates = list(candidates)
+        self.index = {c.name: i for i, c in enumerate(self.candidates)}
+        self.sums = torch.zeros(len(self.candidates), device=device)
+        self.size = 0
+        self.pairwise = pairwise
+        if pairwise is not None and all(c.name in pairwise for c in self.candidates):
+            self._rows = pairwise.rows(c.name for c in self.candidates)
+        else:
+            self.pairwise = None
+        self._embeddings = None
+        # Decks run multiple copies of a card, so keep each card's scores around
+        self._columns: dict[str, torch.Tensor] = {}
+        for c in deck:
+            self.add(c)
+
+    def _score(self, c: card.Card) -> torch.Tensor:
+        global SYNERGY_MODEL
+        if self.pairwise is not None and c.name in self.pairwise:
+            return torch.from_numpy(self.pairwise.column(self._rows, c.name)).to(device)
+        if self._embeddings is None:
+            self._embeddings = stack_embeddings(self.candidates)
+        return synergy_model.score_synergy(SYNERGY_MODEL, self._embeddings, stack_embeddings([c]))[:, 0]
+
+    def add(self, c: card.Card) -> None:
+        """ Adds a card to the deck, updating the sum of every candidate. """
+        column = self._columns.get(c.name)
+        if column is None:
+            column = self._score(c)
+            self._columns[c.name] = column
+        self.sums += column
+        self.size += 1
+
+    def matrix(self, cards) -> dict[str, float]:
+        """ Returns the mean synergy of each of the given candidates against the deck. """
+        means = (self.sums / max(self.size, 1)).tolist()
+        return {c.name: means[self.index[c.name]] for c in cards}
 
 
 def sse(a, b): # sum of square error
@@ -141,51 +194,34 @@ def compute_mana_curve_matrix(deck, legal_cards, mana_curve):
     return legal_card_score
 
 
-def card_group(card):
-    # 0 = creature
-    # 1 = noncreature
-    # 2 = land
-    layout = card.layout
-    faces = card.card_faces
-    if layout in ['split', 'modal_dfc', 'adventure']:
-        if "Creature" in faces[0].cardtypes or "Creature" in faces[1].cardtypes:
-            return 0
-        elif "Land" in faces[0].cardtypes and "Land" in faces[1].cardtypes:
-            # Yes, "and", we only returns land if both faces are lands
-            return 2
-        else:
-            return 1
-    else:
-        if "Creature" in faces[0].cardtypes:
-            return 0
-        elif "Land" in faces[0].cardtypes:
-            return 2
-        else:
-            return 1
-
-
 def compute_strategy_matrix(deck, legal_cards, card_types):
     types_n = len(card_types) - 1
-    deck_card_types = [[card_group(c) for c in deck].count(i) for i in range(types_n)]
+    # Card groups are read from the card index instead of being worked out again every step
+    index = get_index()
+    deck_groups = [int(index.group[index.ids[c.name]]) for c in deck]
+    deck_card_types = [deck_groups.count(i) for i in range(types_n)]
     initial_sse = sse(card_types, deck_card_types)
     new_curve_score = [
         # same as mana curve
         1/(1 + (initial_sse + (1 - 2*(card_types[i] - deck_card_types[i])))/256)
         for i in range(types_n)
     ]
-    legal_card_score = {c.name: new_curve_score[card_group(c)] for c in legal_cards}
+    legal_card_score = {c.name: new_curve_score[index.group[index.ids[c.name]]] for c in legal_cards}
     return legal_card_score
 
 
-def get_max_scoring_card(deck, legal_cards, mana_curve, card_types, weights):
+def get_max_scoring_card(deck, legal_cards, mana_curve, card_types, weights, synergy=None):
     global COST_EFF_MATRIX
     legal_cards = {c for c in legal_cards if c.name in UNLIMITED or deck.count(c) < 4}
-    synergy_matrix = compute_synergy_matrix(deck, legal_cards)
+    if synergy is None:
+        synergy_matrix = compute_synergy_matrix(deck, legal_cards)
+    else:
+        synergy_matrix = synergy.matrix(legal_cards)
     mana_curve_matrix = compute_mana_curve_matrix(deck, legal_cards, mana_curve)
     strategy_matrix = compute_strategy_matrix(deck, legal_cards, card_types)
     scores = {c.name: (
         weights[0] * COST_EFF_MATRIX[c.name],
-        weights[1] * synergy_matrix[c.name].item(),
+        weights[1] * synergy_matrix[c.name],
         weights[2] * mana_curve_matrix[c.name],
         weights[3] * strategy_matrix[c.name]
         ) for c in legal_cards
@@ -197,7 +233,7 @@ def get_max_scoring_card(deck, legal_cards, mana_curve, card_types, weights):
     return max_score_card
 
 
-def generate_deck(starting_cards, legal_cards, mana_curve, card_types, weights=(1.0, 1.0, 1.0, 1.0)):
+def generate_deck(starting_cards, legal_cards, mana_curve, card_types, weights=(1.0, 1.0, 1.0, 1.0), pairwise=None):
     """ Generate a deck of cards given the parameters
 
     Parameters:
@@ -209,6 +245,7 @@ def generate_deck(starting_cards, legal_cards, mana_curve, card_types, weights=(
     card_types (tuple[int, int, int]): The desired number of each card type, in order: creature, noncreature, land
         The sum of this tuple is the desired deck size. In typical constructed formats, this number should be 60.
     set_code (str): The set code to use for loading the synergy model (optional)
+    pairwise (SynergyMatrix): Precomputed synergy scores to look up instead of running the model (optional)
 
     Returns:
     list[Card]: A list of the Card objects of the card in the final deck
@@ -217,52 +254,27 @@ def generate_deck(starting_cards, legal_cards, mana_curve, card_types, weights=(
     deck = starting_cards.copy()
     # cost effectiveness score should be computed outside of the loop
     # since it stays the same throughout the entire process
+    # Likewise, synergy against the cards already in the deck doesn't change,
+    # so only the newly added card needs to be scored on each iteration
+    synergy = SynergyAccumulator(legal_cards, deck, pairwise)
     while (len(deck) < deck_size):
-        c = get_max_scoring_card(deck, legal_cards, mana_curve, card_types, weights)
-        deck.append(card.get_card(c))
+        c = card.get_card(get_max_scoring_card(deck, legal_cards, mana_curve, card_types, weights, synergy))
+        deck.append(c)
+        synergy.add(c)
     return deck
 
 
-def is_nonland(c: card.Card) -> bool:
-    front = "Land" not in c.card_faces[0].cardtypes
-    back = False
-    if not front and c.layout in ['split', 'modal_dfc', 'adventure']:
-        back = "Land" not in c.card_faces[1].cardtypes
-    return front or back
-
-
-PRIMARY_COLORS = ["W", "U", "B", "R", "G", "C"]
-def has_mana_color(symbol, colors):
-    return all(s not in PRIMARY_COLORS or s in colors for s in symbol.split('/'))
-
-
-def is_in_color(c: card.Card, colors: list[str]) -> bool:
-    # Handle adventure lands differently because scryfall decides to put mana cost on the wrong half
-    # Remove when fixed
-    if c.layout == "adventure" and "Land" in c.card_faces[0].cardtypes:
-        mana = c.card_faces[0].mana_cost.strip('{}').split('}{')
-        return all(has_mana_color(m, colors) for m in mana)
-    if c.layout == "meld" and c.card_faces[0].mana_cost == "":
-        return False
-    for f in c.card_faces:
-        if c.layout in ["transform", "flip", "battle"] and f == c.card_faces[1]:
-            continue
-        if "Land" not in f.cardtypes:
-            mana = f.mana_cost.strip('{}').split('}{')
-            if all(has_mana_color(m, colors) for m in mana):
-                return True
-    return False
-
-
 """ Create deck of a specified format at a specified date or release of certain set """
 def create_deck(starting_cards, format, date_or_code, colors, mana_curve, card_types, weights=(1.0,1.0,1.0,1.0)):
     # card.load_cards(data.load(no_download=True))
-    legal_cards = { c for c in get_legal_cards(format, date_or_code) if is_nonland(c) and is_in_color(c, colors) }
+    index = get_index()
+    legal_cards = index.candidates(index.legal_at(format, date_or_code), colors)
     # Extract set code for synergy model
     date, set_code = date_and_code(date_or_code)
     init_cost_effectiveness_matrix(legal_cards)
     init_synergy_model(find_previous_set(date, standard_only=True))
-    return generate_deck(starting_cards, legal_cards, mana_curve, card_types, weights)
+    pairwise = load_synergy_matrix(format, set_code, SYNERGY_MODEL, EMBEDDINGS)
+    return generate_deck(starting_cards, legal_cards, mana_curve, card_types, weights, pairwise)
 
 
 if __name__ == '__main__':
@@ -325,7 +337,8 @@ if __name__ == '__main__':
     )
 
     starting_cards, colors, mana_curve, card_types, weights = monored
-    legal_cards = {c for c in card.get_cards() if c.legalities["standard"] == "legal" and is_nonland(c) and is_in_color(c, colors)}
+    index = get_index()
+    legal_cards = index.candidates(index.legal("standard"), colors)
 
     print("Decklist:")
     # Using the default synergy model for the main function
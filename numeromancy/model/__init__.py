@@ -1,4 +1,5 @@
 import numeromancy.model.cost_model as cost_model
 import numeromancy.model.synergy_model as synergy_model
 from .deck_data import SynergyDataset, read_deck_data, create_deck_data, SYNERGYDIR, TRAIN_SYNERGY, TEST_SYNERGY
-from .card_embedding import CardEmbedding, CardDataset, EmbeddedCardDataset
+from .card_embedding import CardEmbedding, CardDataset, TokenizedCardDataset, PooledCardDataset, LengthBucketSampler, EmbeddedCardDataset, tokenize_texts, pooled_features
+from .embedding_store import EmbeddingStore
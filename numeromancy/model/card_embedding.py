@@ -1,15 +1,77 @@
+import os
+
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 import numpy as np
 from transformers import AutoTokenizer, AutoModel
 
+from numeromancy.preprocessing import read_text
+
+PRETRAINED = "FacebookAI/roberta-base"
+MAX_LENGTH = 50
+
+
+def tokenize_texts(filename, tokenizer=None) -> tuple[np.ndarray, np.ndarray]:
+    """ Returns the input ids and attention masks of the texts in a texts CSV,
+        one row per row of read_text(filename), padded to MAX_LENGTH.
+        They are cached in filename.tokens.npz until the CSV or PRETRAINED changes. """
+    cache_file = filename + '.tokens.npz'
+    stat = os.stat(filename)
+    source = np.array([stat.st_mtime_ns, stat.st_size, MAX_LENGTH], dtype=np.int64)
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as cache:
+            if (np.array_equal(cache['source'], source) and 'pretrained' in cache
+                    and str(cache['pretrained']) == PRETRAINED):
+                return cache['input_ids'], cache['attention_mask']
+    if tokenizer is None:
+        tokenizer = AutoTokenizer.from_pretrained(PRETRAINED)
+    if tokenizer is None:
+        raise RuntimeError(f"No tokenizer found for {PRETRAINED}")
+    texts = [text for _, text in read_text(filename)]
+    tokens = tokenizer(texts, padding='max_length', truncation=True, return_tensors='np', max_length=MAX_LENGTH)
+    input_ids = tokens['input_ids'].astype(np.int32)
+    attention_mask = tokens['attention_mask'].astype(np.int8)
+    with open(cache_file + '.tmp', 'wb') as f:
+        np.savez(f, source=source, pretrained=np.array(PRETRAINED), input_ids=input_ids, attention_mask=attention_mask)
+    os.replace(cache_file + '.tmp', cache_file)
+    return input_ids, attention_mask
+
+
+def pooled_features(model, filename, batch_size=256) -> np.ndarray:
+    """ Returns the pretrained transformer's mean-pooled outputs for the texts in
+        a texts CSV, one row per row of read_text(filename), as float32.
+        Only valid while the transformer is frozen, they are cached in
+        filename.pooled.npz until the CSV changes. """
+    cache_file = filename + '.pooled.npz'
+    stat = os.stat(filename)
+    source = np.array([stat.st_mtime_ns, stat.st_size, MAX_LENGTH], dtype=np.int64)
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as cache:
+            if np.array_equal(cache['source'], source) and str(cache['pretrained']) == PRETRAINED:
+                return cache['pooled']
+    input_ids, attention_mask = tokenize_texts(filename, model.tokenize)
+    input_ids = torch.from_numpy(input_ids)
+    attention_mask = torch.from_numpy(attention_mask)
+    was_training = model.training
+    model.eval()
+    pooled = []
+    with torch.no_grad():
+        for i in range(0, len(input_ids), batch_size):
+            pooled.append(model.pool_tokens(input_ids[i:i+batch_size], attention_mask[i:i+batch_size]).cpu().numpy())
+    model.train(was_training)
+    pooled = np.concatenate(pooled) if pooled else np.zeros((0, 768), dtype=np.float32)
+    with open(cache_file + '.tmp', 'wb') as f:
+        np.savez(f, source=source, pretrained=np.array(PRETRAINED), pooled=pooled.astype(np.float32))
+    os.replace(cache_file + '.tmp', cache_file)
+    return pooled.astype(np.float32)
+
 
 class CardEmbedding(nn.Module):
     def __init__(self):
         super(CardEmbedding, self).__init__()
-        self.tokenize = AutoTokenizer.from_pretrained("FacebookAI/roberta-base")
-        self.transformer = AutoModel.from_pretrained("FacebookAI/roberta-base")
+        self.tokenize = AutoTokenizer.from_pretrained(PRETRAINED)
+        self.transformer = AutoModel.from_pretrained(PRETRAINED)
         self.embedder = nn.Sequential(
                 nn.Linear(799, 64),
                 nn.ReLU(),
@@ -22,16 +84,28 @@ class CardEmbedding(nn.Module):
         return sum_embeddings / sum_mask
 
     def forward(self, props, text):
+        text = self.tokenize(text, padding=True, truncation=True, return_tensors="pt", max_length=MAX_LENGTH)
+        return self.forward_tokens(props, text['input_ids'], text['attention_mask'])
+
+    def forward_tokens(self, props, input_ids, attention_mask):
+        """ Like forward, with texts already tokenized, e.g. by tokenize_texts. """
+        return self.embed_pooled(props, self.pool_tokens(input_ids, attention_mask))
+
+    def pool_tokens(self, input_ids, attention_mask):
+        """ The transformer's mean-pooled output for tokenized texts.
+            Padding beyond the longest text of the batch is trimmed first. """
         device = next(self.parameters()).device
-        props = props.to(device)
+        length = max(int(attention_mask.sum(dim=1).max()), 1)
+        input_ids = input_ids[:, :length].to(device).long()
+        attention_mask = attention_mask[:, :length].to(device).long()
 
-        text = self.tokenize(text, padding=True, truncation=True, return_tensors="pt", max_length=50).to(device)
-        encoded = {k: v.to(device) for k,v in text.items()}
+        output = self.transformer(input_ids=input_ids, attention_mask=attention_mask)
+        return self.mean_pooling(output.last_hidden_state, attention_mask)
 
-        output = self.transformer(**text)
-        pooled = self.mean_pooling(output.last_hidden_state, encoded['attention_mask'])
-        embedding = self.embedder(torch.cat((props, pooled), dim=1))
-        return embedding
+    def embed_pooled(self, props, pooled):
+        """ The embedding of cards from their props and pooled texts, e.g. from pooled_features. """
+        device = next(self.parameters()).device
+        return self.embedder(torch.cat((props.to(device), pooled.to(device)), dim=1))
 
 
 class CardDataset(Dataset):
@@ -47,6 +121,95 @@ class CardDataset(Dataset):
         return self.props[idx], self.text[idx], self.cmc[idx]
 
 
+class TokenizedCardDataset(Dataset):
+    def __init__(self, props, input_ids, attention_mask, cmc):
+        self.props = props
+        self.input_ids = input_ids
+        self.attention_mask = attention_mask
+        self.cmc = cmc
+
+    def __len__(self):
+        return len(self.cmc)
+
+    def __getitem__(self, index):
+        return self.props[index], self.input_ids[index], self.attention_mask[index], self.cmc[index]
+
+
+class LengthBucketSampler(Sampler):
+    """ Batches the texts of a TokenizedCardDataset by similar token length, so that short
+        texts aren't padded to the length of long ones. Batches hold up to batch_size texts,
+        and if max_tokens is given, as many texts as fit within max_tokens once padded.
+        When shuffling, texts are sorted by length within random pools of pool_size batches,
+        and the batches are served in random order. """
+
+    def __init__(self, lengths, batch_size: int | None = 128, max_tokens: int | None = None,
+                 shuffle=False, pool_size=50):
+        if batch_size is None and max_tokens is None:
+            raise ValueError("LengthBucketSampler needs a batch_size or max_tokens.")
+        self.lengths = np.maximum(np.asarray(lengths), 1)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.pool_size = pool_size
+        self._next = self._batches()
+
+    @classmethod
+    def from_dataset(cls, dataset: TokenizedCardDataset, **kwargs) -> 'LengthBucketSampler':
+        return cls(np.asarray(dataset.attention_mask.sum(dim=1)), **kwargs)
+
+    def _batches(self) -> list[list[int]]:
+        n = len(self.lengths)
+        if self.shuffle and n:
+            order = np.random.permutation(n)
+            per_batch = self.batch_size or max(1, (self.max_tokens or 0) // max(int(self.lengths.mean()), 1))
+            pool = per_batch * self.pool_size
+            order = np.concatenate([
+                chunk[np.argsort(self.lengths[chunk], kind='stable')]
+                for chunk in np.array_split(order, range(pool, n, pool))])
+        else:
+            order = np.argsort(self.lengths, kind='stable')
+        batches = []
+        batch = []
+        longest = 0
+        for i in order.tolist():
+            length = int(self.lengths[i])
+            full = self.batch_size is not None and len(batch) >= self.batch_size
+            over = self.max_tokens is not None and max(longest, length) * (len(batch) + 1) > self.max_tokens
+            if batch and (full or over):
+                batches.append(batch)
+                batch = []
+                longest = 0
+            batch.append(i)
+            longest = max(longest, length)
+        if batch:
+            batches.append(batch)
+        if self.shuffle:
+            np.random.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        # The batches of the next epoch are made ahead so that __len__ matches them
+        batches = self._next
+        self._next = self._batches()
+        return iter(batches)
+
+    def __len__(self):
+        return len(self._next)
+
+
+class PooledCardDataset(Dataset):
+    def __init__(self, props, pooled, cmc):
+        self.props = props
+        self.pooled = pooled
+        self.cmc = cmc
+
+    def __len__(self):
+        return len(self.cmc)
+
+    def __getitem__(self, index):
+        return self.props[index], self.pooled[index], self.cmc[index]
+
+
 class EmbeddedCardDataset(Dataset):
     def __init__(self, emb, cmc):
         self.emb = emb
@@ -1,3 +1,5 @@
+import argparse
+import hashlib
 import os
 import numpy as np
 import torch
@@ -7,7 +9,8 @@ from torch.utils.data import DataLoader
 from progressbar import progressbar
 
 from numeromancy.preprocessing import CARD_TEXTS, TRAIN_TEXTS, TEST_TEXTS, props_vector, read_text
-from .card_embedding import CardEmbedding, CardDataset
+from .card_embedding import CardEmbedding, CardDataset, LengthBucketSampler, PooledCardDataset, TokenizedCardDataset, pooled_features, tokenize_texts
+from .embedding_store import EmbeddingStore
 import numeromancy.card as card
 import numeromancy.data as data
 import numeromancy.util as util
@@ -17,7 +20,9 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 MODELDIR = os.path.join(data.OUTPUTDIR, 'model')
 CARD_EMBEDDING = os.path.join(MODELDIR, 'card_embedding')
 COST_CLASSIFIER = os.path.join(MODELDIR, 'classifier')
+# Embeddings used to be saved as a dict from face name to tensor, and are converted from it
 EMBEDDING_DICT = os.path.join(MODELDIR, 'card_embedding.pt')
+EMBEDDING_STORE = os.path.join(MODELDIR, 'card_embedding_store')
 
 
 def load_model(emb_path=CARD_EMBEDDING, clf_path=COST_CLASSIFIER):
@@ -38,74 +43,163 @@ def load_model(emb_path=CARD_EMBEDDING, clf_path=COST_CLASSIFIER):
     return emb, clf
 
 
-def save_card_embedding():
+def face_hash(name: str, text: str, props: np.ndarray) -> str:
+    """ A hash of everything a face's embedding is computed from. """
+    h = hashlib.sha1()
+    h.update(name.encode('UTF8'))
+    h.update(b'\0')
+    h.update(text.encode('UTF8'))
+    h.update(b'\0')
+    h.update(np.ascontiguousarray(props, dtype=np.float32).tobytes())
+    return h.hexdigest()
+
+
+def save_card_embedding(batch_size=128, max_tokens=None, incremental=False):
+    """ Embeds every card face and saves the embeddings. If incremental is set and
+        embeddings from the same model were saved before, only the faces that are new,
+        or whose text or props changed, are embedded, and the rest are kept. """
     emb, _ = load_model()
+    checksum = util.model_checksum(emb)
     card.load_cards(data.load())
     cards = card.get_cards()
-    face_names = list(f.name for c in cards for f in c.card_faces)
+    face_names = list(dict.fromkeys(f.name for c in cards for f in c.card_faces))
     pv = props_vector(cards)
-    texts = dict(read_text(CARD_TEXTS))
-    dataset = [(torch.from_numpy(pv[f]).float().to("cpu"),
-            texts[f],
-            f)
-            for f in face_names]
-    dataset = util.transpose(dataset)
+    input_ids, attention_mask = tokenize_texts(CARD_TEXTS)
+    texts = read_text(CARD_TEXTS)
+    rows = {name: i for i, (name, _) in enumerate(texts)}
+    hashes = {f: face_hash(f, texts[rows[f]][1], pv[f]) for f in face_names}
+
+    store = None
+    if incremental and EmbeddingStore.exists(EMBEDDING_STORE):
+        store = EmbeddingStore.load(EMBEDDING_STORE)
+        if store.model != checksum or store.hashes is None:
+            store = None
+    if store is not None:
+        face_names = [f for f in face_names if not store.is_current(f, hashes[f])]
+        if not face_names:
+            return
+
+    face_rows = [rows[f] for f in face_names]
+    dataset = TokenizedCardDataset(
+        torch.from_numpy(pv.gather(face_names)).float(),
+        torch.from_numpy(input_ids[face_rows]),
+        torch.from_numpy(attention_mask[face_rows]),
+        face_names)
+    # Faces of similar text length are embedded together to avoid padding
     dataloader = DataLoader(
-        CardDataset(dataset[0], dataset[1], dataset[2]),
-        batch_size=128)
+        dataset,
+        batch_sampler=LengthBucketSampler.from_dataset(dataset, batch_size=batch_size, max_tokens=max_tokens))
 
     with torch.no_grad():
-        embeddings = {}
-        for props, text, name in progressbar(dataloader):
-            embed = emb(props, text).to("cpu")
-            for n, e in zip(name, embed):
-                embeddings[n] = e
-        torch.save(embeddings, EMBEDDING_DICT)
+        names = []
+        embeddings = []
+        for props, input_ids, attention_mask, name in progressbar(dataloader):
+            embeddings.append(emb.forward_tokens(props, input_ids, attention_mask).to("cpu"))
+            names.extend(name)
+    embeddings = torch.cat(embeddings).numpy()
 
+    if store is not None and store.hashes is not None:
+        # Changed faces are overwritten in place, and new ones appended
+        all_names = list(store.names)
+        all_hashes = list(store.hashes)
+        matrix = np.array(store.matrix)
+        new = []
+        for name, embedding in zip(names, embeddings):
+            if name in store.index:
+                matrix[store.index[name]] = embedding
+                all_hashes[store.index[name]] = hashes[name]
+            else:
+                new.append(embedding)
+                all_names.append(name)
+                all_hashes.append(hashes[name])
+        if new:
+            matrix = np.concatenate((matrix, np.stack(new)))
+        del store
+        EmbeddingStore.save(EMBEDDING_STORE, all_names, matrix, all_hashes, checksum)
+    else:
+        EmbeddingStore.save(EMBEDDING_STORE, names, embeddings, [hashes[n] for n in names], checksum)
 
-def load_card_embedding():
-    embeddings = torch.load(EMBEDDING_DICT)
-    return embeddings
 
+def labelled_faces(texts_file, pv, cv, num_classes=8) -> tuple[list[int], torch.Tensor, list[int]]:
+    """ The rows of a texts CSV whose faces have props, with their props
+        and their cmc, capped at num_classes-1, as the label. """
+    texts = read_text(texts_file)
+    rows = [i for i, (name, _) in enumerate(texts) if name in pv]
+    names = [texts[i][0] for i in rows]
+    props = torch.from_numpy(pv.gather(names)).float()
+    labels = [min(int(cv[name].item()), num_classes-1) for name in names]
+    return rows, props, labels
+
+
+def tokenized_dataset(texts_file, pv, cv, num_classes=8) -> TokenizedCardDataset:
+    """ The labelled faces of a texts CSV with their tokenized texts. """
+    input_ids, attention_mask = tokenize_texts(texts_file)
+    rows, props, labels = labelled_faces(texts_file, pv, cv, num_classes)
+    return TokenizedCardDataset(
+        props,
+        torch.from_numpy(input_ids[rows]),
+        torch.from_numpy(attention_mask[rows]),
+        labels)
 
-if __name__ == '__main__':
-    epochs = 300
-    batch_size = 128
-    num_classes = 8
 
+def pooled_dataset(emb: CardEmbedding, texts_file, pv, cv, num_classes=8) -> PooledCardDataset:
+    """ The labelled faces of a texts CSV with the transformer's cached pooled outputs of their texts. """
+    pooled = pooled_features(emb, texts_file)
+    rows, props, labels = labelled_faces(texts_file, pv, cv, num_classes)
+    return PooledCardDataset(props, torch.from_numpy(pooled[rows]), labels)
+
+
+def load_card_embedding() -> EmbeddingStore:
+    """ Memory-maps the saved card embeddings, converting them from the
+        legacy dict of tensors if they haven't been yet. """
+    if not EmbeddingStore.exists(EMBEDDING_STORE) and os.path.exists(EMBEDDING_DICT):
+        embeddings = torch.load(EMBEDDING_DICT)
+        EmbeddingStore.save(EMBEDDING_STORE, list(embeddings), torch.stack(list(embeddings.values())).numpy())
+    return EmbeddingStore.load(EMBEDDING_STORE)
+
+
+def train_model(epochs=300, batch_size=128, num_classes=8, freeze_backbone=False, max_tokens=None):
+    """ Trains the card embedding along with a classifier predicting the cmc of each face,
+        and saves them. If freeze_backbone is set, the transformer keeps its pretrained
+        weights: its pooled outputs are computed once and cached on disk, and only the
+        embedder and the classifier are trained on them. This is much faster, especially
+        without a GPU. Otherwise, texts are batched by similar token length, and if
+        max_tokens is given, batches are also limited to max_tokens padded tokens. """
     card.load_cards(data.load(no_download=True))
     cards = card.get_cards()
 
     emb = CardEmbedding().to(device)
     for param in emb.transformer.parameters():
-        param.requires_grad = True
+        param.requires_grad = not freeze_backbone
 
     # TODO maybe filter lands out of the data
     pv = props_vector(cards, backface=False)
     cv = props_vector(cards, props=['cmc'], backface=False)
 
-    train_texts = [(name, text) for name, text in read_text(TRAIN_TEXTS) if name in pv]
-    test_texts = [(name, text) for name, text in read_text(TEST_TEXTS) if name in pv]
-    # train_items = [(k, v) for k, v in train_texts if k in pv]
-    # test_items = [(k, v) for k, v in test_texts if k in pv]
-
-    train_dataset = [(torch.from_numpy(pv[name]).float(), text, min(int(cv[name].item()), num_classes-1)) for name, text in train_texts]
-    train_dataset = util.transpose(train_dataset)
-    test_dataset = [(torch.from_numpy(pv[name]).float(), text, min(int(cv[name].item()), num_classes-1)) for name, text in test_texts]
-    test_dataset = util.transpose(test_dataset)
-    y_train = train_dataset[2]
-    y_test = test_dataset[2]
-    train_loader = DataLoader(
-        CardDataset(train_dataset[0],
-                    train_dataset[1],
-                    y_train),
-        batch_size=batch_size,
-        shuffle=True)
-    test_loader = DataLoader(
-        CardDataset(test_dataset[0],
-                    test_dataset[1],
-                    y_test),
-        batch_size=batch_size)
+    # Texts are tokenized once and cached, not on every forward pass
+    if freeze_backbone:
+        train_dataset = pooled_dataset(emb, TRAIN_TEXTS, pv, cv, num_classes)
+        test_dataset = pooled_dataset(emb, TEST_TEXTS, pv, cv, num_classes)
+        encode = emb.embed_pooled
+        train_loader = DataLoader(
+            train_dataset,
+            batch_size=batch_size,
+            shuffle=True)
+        test_loader = DataLoader(
+            test_dataset,
+            batch_size=batch_size)
+    else:
+        train_dataset = tokenized_dataset(TRAIN_TEXTS, pv, cv, num_classes)
+        test_dataset = tokenized_dataset(TEST_TEXTS, pv, cv, num_classes)
+        encode = emb.forward_tokens
+        train_loader = DataLoader(
+            train_dataset,
+            batch_sampler=LengthBucketSampler.from_dataset(
+                train_dataset, batch_size=batch_size, max_tokens=max_tokens, shuffle=True))
+        test_loader = DataLoader(
+            test_dataset,
+            batch_sampler=LengthBucketSampler.from_dataset(
+                test_dataset, batch_size=batch_size, max_tokens=max_tokens))
 
     simple_clf = nn.Sequential(
         nn.Linear(64, 64),
@@ -117,7 +211,7 @@ if __name__ == '__main__':
         nn.Linear(64, 1)).to(device)
 
     optimizer = torch.optim.Adam(
-        list(emb.parameters()) + list(simple_clf.parameters()),
+        [p for p in emb.parameters() if p.requires_grad] + list(simple_clf.parameters()),
         lr=2e-5)
     loss_fn = nn.MSELoss()
 
@@ -126,9 +220,9 @@ if __name__ == '__main__':
 
     for epoch in range(epochs):
         total_loss = 0
-        for props, text, label in progressbar(train_loader):
+        for props, *inputs, label in progressbar(train_loader):
             label = label.to(device).float().unsqueeze(1)
-            embedding = emb(props, text)
+            embedding = encode(props, *inputs)
             logits = simple_clf(embedding)
             loss = loss_fn(logits, label)
 
@@ -144,8 +238,8 @@ if __name__ == '__main__':
     with torch.no_grad():
         sse = 0.0
         size = 0
-        for props, text, label in progressbar(test_loader):
-            embedding = emb(props, text)
+        for props, *inputs, label in progressbar(test_loader):
+            embedding = encode(props, *inputs)
             y_pred = simple_clf(embedding)
             #y_pred = torch.argmax(logits, dim=1)
             sse += sum(cmc - y for cmc, y in zip(label, y_pred))
@@ -158,6 +252,19 @@ if __name__ == '__main__':
     torch.save(emb.state_dict(), CARD_EMBEDDING)
     torch.save(simple_clf.state_dict(), COST_CLASSIFIER)
 
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Trains the card embedding and the cmc classifier.")
+    parser.add_argument('--epochs', type=int, default=300)
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--freeze-backbone', action='store_true',
+                        help="keep the pretrained transformer weights and train on its cached pooled outputs")
+    parser.add_argument('--max-tokens', type=int, default=None,
+                        help="limit each batch to this many padded tokens")
+    args = parser.parse_args()
+    train_model(epochs=args.epochs, batch_size=args.batch_size,
+                freeze_backbone=args.freeze_backbone, max_tokens=args.max_tokens)
+
     """
     with torch.no_grad():
         x_train = []
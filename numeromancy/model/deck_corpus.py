@@ -0,0 +1,304 @@
+""" deck_corpus - Decklists parsed across processes into integer-encoded shards on disk
+
+Decklists live in data/decklists/<format>/<set>/<archetype>/, one file per deck.
+Each set becomes a shard of the corpus: the card ids of every deck, stored back to back,
+with the copy count of each card, the offset where each deck ends, and a JSON list of
+where each deck came from. Card ids index into the corpus vocabulary, which is only
+ever appended to, so shards stay valid as new decklists are ingested. """
+
+import json
+import logging
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from progressbar import progressbar
+
+import numeromancy.card as card
+import numeromancy.data as data
+from numeromancy.card_pool import is_nonland
+from numeromancy.format import SETS
+from numeromancy.parse_decklist import parse_decklist
+
+_logger = logging.getLogger(__name__)
+
+DECKLISTDIR = os.path.join(data.DATADIR, 'decklists')
+DECK_CORPUSDIR = os.path.join(data.OUTPUTDIR, 'deck_corpus')
+
+
+def resolve_name(name: str) -> str:
+    """ The full name of the card a decklist refers to by name. """
+    try:
+        card.get_card(name)
+        return name
+    except KeyError:
+        return card.find_name(name)
+
+
+def read_decklist(filepath) -> dict[str, int]:
+    """ Parses a decklist file into the full names and copy counts of its nonland cards.
+        Names that don't match a card are skipped. """
+    with open(filepath, 'r') as f:
+        deck = parse_decklist(f.read(), limit=60)
+    cards = {}
+    for name, count in deck.items():
+        if name == "Unknown Card":
+            continue
+        try:
+            name = resolve_name(name)
+        except KeyError as e:
+            _logger.warning(f"{filepath}: {e.args[0]}")
+            continue
+        if is_nonland(card.get_card(name)):
+            cards[name] = cards.get(name, 0) + count
+    return cards
+
+
+_deck_filename = re.compile(r"(?:(?P<tag>[A-Z0-9]+)_)?(?P<event>.*?)\s+#(?P<placement>\d+)\b")
+def parse_deck_filename(filename: str) -> tuple[str, int | None]:
+    """ Returns the event and placement named by a decklist file, e.g.
+        "TOP8_MCQ Barcelona @ Mana Base (Malaysia) #1 Boros Feather - Justin Chin.dek"
+        was placed 1st at "MCQ Barcelona @ Mana Base (Malaysia)".
+        Files not named that way have no placement. """
+    stem = os.path.splitext(filename)[0]
+    match = _deck_filename.match(stem)
+    if match is None:
+        return stem, None
+    return match.group('event'), int(match.group('placement'))
+
+
+def decklist_files(format, set_codes=None, decklist_dir=DECKLISTDIR) -> list[tuple[str, str, str]]:
+    """ Lists the (set code, archetype, path) of every decklist file of the format,
+        in the given sets or all of them, in a stable order. """
+    format_dir = os.path.join(decklist_dir, format.lower())
+    if set_codes is None:
+        set_codes = os.listdir(format_dir)
+    files = []
+    for set_code in sorted(set_codes):
+        set_dir = os.path.join(format_dir, set_code)
+        if not os.path.isdir(set_dir):
+            continue
+        for archetype in sorted(os.listdir(set_dir)):
+            deck_dir = os.path.join(set_dir, archetype)
+            if not os.path.isdir(deck_dir):
+                continue
+            for deck in sorted(os.listdir(deck_dir)):
+                filepath = os.path.join(deck_dir, deck)
+                if os.path.isfile(filepath):
+                    files.append((set_code, archetype, filepath))
+    return files
+
+
+class Vocabulary:
+    """ Append-only mapping between card names and their ids in a corpus. """
+
+    def __init__(self, names=()):
+        self.names = list(names)
+        self.ids = {name: i for i, name in enumerate(self.names)}
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def add(self, name: str) -> int:
+        """ Returns the id of the name, giving it the next id if it's new. """
+        i = self.ids.get(name)
+        if i is None:
+            i = len(self.names)
+            self.ids[name] = i
+            self.names.append(name)
+        return i
+
+
+def _open_truncated(path: str, size: int):
+    f = open(path, 'ab')
+    f.truncate(size)
+    return f
+
+
+def _read_array(path: str, dtype) -> np.ndarray:
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+class ShardWriter:
+    """ Appends decks to the files of a corpus shard as they arrive.
+        Anything past the first n decks, left over by an ingestion that
+        didn't finish, is cut off first. """
+
+    def __init__(self, path: str, n: int = 0):
+        ends = _read_array(path + '.ends', np.int64)
+        self.end = int(ends[n-1]) if n else 0
+        del ends
+        self.ids = _open_truncated(path + '.ids', self.end * np.dtype(np.int32).itemsize)
+        self.counts = _open_truncated(path + '.counts', self.end * np.dtype(np.int16).itemsize)
+        self.ends = _open_truncated(path + '.ends', n * np.dtype(np.int64).itemsize)
+
+    def append(self, ids: np.ndarray, counts: np.ndarray) -> None:
+        ids.astype(np.int32).tofile(self.ids)
+        counts.astype(np.int16).tofile(self.counts)
+        self.end += len(ids)
+        np.array([self.end], dtype=np.int64).tofile(self.ends)
+
+    def close(self) -> None:
+        for f in (self.ids, self.counts, self.ends):
+            f.close()
+
+
+class DeckCorpus:
+    """ The integer-encoded decklists of a format, one shard per set. """
+
+    def __init__(self, format, corpus_dir=DECK_CORPUSDIR):
+        self.format = format.lower()
+        self.directory = os.path.join(corpus_dir, self.format)
+        self.vocabulary_file = os.path.join(self.directory, 'vocabulary.json')
+        if os.path.exists(self.vocabulary_file):
+            with open(self.vocabulary_file, 'r') as f:
+                self.vocabulary = Vocabulary(json.load(f))
+        else:
+            self.vocabulary = Vocabulary()
+
+    def shard_path(self, set_code: str) -> str:
+        return os.path.join(self.directory, set_code.upper())
+
+    def set_codes(self) -> list[str]:
+        """ The sets with a shard in the corpus, from oldest to newest. """
+        if not os.path.isdir(self.directory):
+            return []
+        codes = {f.split('.')[0] for f in os.listdir(self.directory) if f.endswith('.ends')}
+        return sorted(codes, key=lambda code: SETS[code].date)
+
+    def save_vocabulary(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.vocabulary_file + '.tmp', 'w') as f:
+            json.dump(self.vocabulary.names, f)
+        os.replace(self.vocabulary_file + '.tmp', self.vocabulary_file)
+
+    def remove_shard(self, set_code: str) -> None:
+        path = self.shard_path(set_code)
+        for ext in ('.ids', '.counts', '.ends', '.json'):
+            if os.path.exists(path + ext):
+                os.remove(path + ext)
+
+    def deck_info(self, set_code: str) -> list[dict]:
+        """ Where each deck of a set's shard came from: the decklist file relative to
+            the format's decklist directory, its archetype, event and placement. """
+        path = self.shard_path(set_code) + '.json'
+        if not os.path.exists(path):
+            return []
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def save_deck_info(self, set_code: str, info: list[dict]) -> None:
+        path = self.shard_path(set_code) + '.json'
+        with open(path + '.tmp', 'w') as f:
+            json.dump(info, f)
+        os.replace(path + '.tmp', path)
+
+    def shard(self, set_code: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ Memory-maps the card ids, copy counts and deck end offsets of a set's shard. """
+        path = self.shard_path(set_code)
+        # Decks missing from the deck info were cut off while being ingested
+        ends = _read_array(path + '.ends', np.int64)[:len(self.deck_info(set_code))]
+        stop = int(ends[-1]) if len(ends) else 0
+        ids = _read_array(path + '.ids', np.int32)[:stop]
+        counts = _read_array(path + '.counts', np.int16)[:stop]
+        return ids, counts, ends
+
+    def decks(self, set_code: str) -> list[np.ndarray]:
+        """ Returns the card ids of each deck of a set. """
+        ids, _, ends = self.shard(set_code)
+        return np.split(ids, ends[:-1]) if len(ends) else []
+
+    def decks_until(self, set_code: str) -> list[np.ndarray]:
+        """ Returns the card ids of each deck from the sets released on or before the set. """
+        date = SETS[set_code].date
+        return [deck for s in self.set_codes() if SETS[s].date <= date for deck in self.decks(s)]
+
+
+_vocabulary: dict[str, int] = {}
+
+
+def _encode_shard(filepaths: list[str]) -> tuple[list[tuple[np.ndarray, np.ndarray]], list[str]]:
+    """ Reads and encodes a shard of decklist files in a worker process.
+        Names missing from the vocabulary the worker was forked with get
+        negative ids: -1 - i for the i-th of the returned new names. """
+    new_names: dict[str, int] = {}
+    decks = []
+    for filepath in filepaths:
+        deck = read_decklist(filepath)
+        ids = np.fromiter(
+            (_vocabulary[name] if name in _vocabulary else -1 - new_names.setdefault(name, len(new_names))
+             for name in deck),
+            dtype=np.int32, count=len(deck))
+        counts = np.fromiter(deck.values(), dtype=np.int16, count=len(deck))
+        decks.append((ids, counts))
+    return decks, list(new_names)
+
+
+def ingest(format, set_codes=None, processes=None, shard_size=64, rebuild=False,
+           decklist_dir=DECKLISTDIR, corpus_dir=DECK_CORPUSDIR) -> DeckCorpus:
+    """ Parses the decklists of the given sets of a format (all of them by default) across
+        processes into the format's corpus. Only files that aren't in the corpus yet are
+        parsed and appended to their set's shard, unless rebuild is set, in which case
+        the shards of those sets are parsed again from scratch.
+        Files are sent to the workers shard_size at a time, and the encoded decks are
+        written to disk as they come back. The cards must already be loaded. """
+    global _vocabulary
+    corpus = DeckCorpus(format, corpus_dir)
+    format_dir = os.path.join(decklist_dir, corpus.format)
+    files = decklist_files(format, set_codes, decklist_dir)
+
+    info = {}
+    for set_code in dict.fromkeys(s for s, _, _ in files):
+        if rebuild:
+            corpus.remove_shard(set_code)
+        info[set_code] = corpus.deck_info(set_code)
+    ingested = {d['file'] for set_info in info.values() for d in set_info}
+    files = [(s, a, path) for s, a, path in files if os.path.relpath(path, format_dir) not in ingested]
+
+    shards = []
+    for i in range(0, len(files), shard_size):
+        chunk = files[i:i+shard_size]
+        # Keep each shard within one set so its decks go to a single writer
+        for set_code in dict.fromkeys(s for s, _, _ in chunk):
+            shards.append((set_code, [(a, path) for s, a, path in chunk if s == set_code]))
+    if not shards:
+        return corpus
+
+    os.makedirs(corpus.directory, exist_ok=True)
+    writers = {}
+    for set_code in dict.fromkeys(s for s, _ in shards):
+        writers[set_code] = ShardWriter(corpus.shard_path(set_code), len(info[set_code]))
+
+    # Workers are forked, inheriting the loaded cards, their name index and the vocabulary so far
+    card.get_name_index()
+    _vocabulary = corpus.vocabulary.ids
+    context = multiprocessing.get_context('fork')
+    try:
+        with ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+            results = executor.map(_encode_shard, [[path for _, path in decks] for _, decks in shards])
+            for (set_code, decks), (encoded, new_names) in progressbar(zip(shards, results), max_value=len(shards)):
+                new_ids = np.array([corpus.vocabulary.add(name) for name in new_names], dtype=np.int32)
+                for (archetype, path), (ids, counts) in zip(decks, encoded):
+                    if len(new_ids):
+                        ids = np.where(ids < 0, new_ids[-1 - np.minimum(ids, -1)], ids)
+                    writers[set_code].append(ids, counts)
+                    event, placement = parse_deck_filename(os.path.basename(path))
+                    info[set_code].append({
+                        'file': os.path.relpath(path, format_dir),
+                        'archetype': archetype,
+                        'event': event,
+                        'placement': placement,
+                    })
+    finally:
+        _vocabulary = {}
+        for writer in writers.values():
+            writer.close()
+        # The vocabulary goes first so the shards never refer to unknown ids
+        corpus.save_vocabulary()
+        for set_code in writers:
+            corpus.save_deck_info(set_code, info[set_code])
+    return corpus
@@ -1,13 +1,13 @@
-import math
 import os
 import random
-import csv
+import json
 from itertools import islice
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from collections import defaultdict
+from typing import NamedTuple
 
+import numpy as np
 import torch
-from torch.utils.data import Dataset
+from scipy import sparse
+from torch.utils.data import BatchSampler, DataLoader, Dataset, RandomSampler, SequentialSampler
 from progressbar import progressbar
 
 import numeromancy.card as card
@@ -16,67 +16,134 @@ import numeromancy.util as util
 from numeromancy.preprocessing import CARD_TEXTS, props_vector
 from numeromancy.parse_decklist import parse_decklist
 from numeromancy.format import SETS
-from numeromancy.deck_generator import is_nonland
 from .card_embedding import CardEmbedding
+from .deck_corpus import DECKLISTDIR, ingest, resolve_name
 from .cost_model import CARD_EMBEDDING, load_card_embedding
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 SYNERGYDIR = os.path.join(data.OUTPUTDIR, 'synergy')
-TRAIN_SYNERGY = os.path.join(SYNERGYDIR, 'train_synergy.csv')
-TEST_SYNERGY = os.path.join(SYNERGYDIR, 'test_synergy.csv')
+TRAIN_SYNERGY = os.path.join(SYNERGYDIR, 'train_synergy.pairs')
+TEST_SYNERGY = os.path.join(SYNERGYDIR, 'test_synergy.pairs')
+
+# Synergy pair files start with PAIRS_MAGIC and the length of a JSON header, which records
+# the number of pairs, whether they are weighted, and the card names the card ids refer to.
+# The columns follow back to back, starting on an 8-byte boundary: the int32 card ids of
+# the first and second cards, the float32 value (a label or a score) and the optional
+# float32 weight of each pair.
+PAIRS_MAGIC = b'NMPAIRS1'
 
 
 class SynergyDataset(Dataset):
-    def __init__(self, emb1, emb2, synergy):
-        self.emb1 = emb1
-        self.emb2 = emb2
+    """ Pairs of cards stored as two columns of card indices and a synergy column,
+        which may be memory-mapped. The embeddings of a pair are gathered from a single
+        matrix, whose rows are the cards, when the pair is fetched.
+        Indexing with a list of indices fetches the whole batch with one gather,
+        as synergy_loader does. """
+
+    def __init__(self, embeddings: torch.Tensor, c1: np.ndarray, c2: np.ndarray, synergy: np.ndarray):
+        self.embeddings = embeddings
+        self.c1 = c1
+        self.c2 = c2
         self.synergy = synergy
 
     def __len__(self):
         return len(self.synergy)
 
     def __getitem__(self, idx):
-        return self.emb1[idx], self.emb2[idx], self.synergy[idx]
+        c1 = torch.from_numpy(np.asarray(self.c1[idx], dtype=np.int64))
+        c2 = torch.from_numpy(np.asarray(self.c2[idx], dtype=np.int64))
+        synergy = torch.from_numpy(np.array(self.synergy[idx], dtype=np.float32))
+        return self.embeddings[c1], self.embeddings[c2], synergy
+
+
+class SynergyPairs(NamedTuple):
+    names: list[str]
+    c1: np.ndarray
+    c2: np.ndarray
+    value: np.ndarray
+    weight: np.ndarray | None
+
+
+def write_pairs(filename, names, c1, c2, value, weight=None) -> None:
+    """ Writes card pairs in the synergy pair format. c1 and c2 are card ids into names. """
+    header = json.dumps({'count': len(c1), 'weighted': weight is not None, 'names': list(names)}).encode('UTF8')
+    header += b' ' * (-(len(PAIRS_MAGIC) + 8 + len(header)) % 8)
+    columns = [(c1, np.int32), (c2, np.int32), (value, np.float32)]
+    if weight is not None:
+        columns.append((weight, np.float32))
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(PAIRS_MAGIC)
+        f.write(np.array([len(header)], dtype='<u8').tobytes())
+        f.write(header)
+        for column, dtype in columns:
+            np.ascontiguousarray(column, dtype=np.dtype(dtype).newbyteorder('<')).tofile(f)
+    os.replace(filename + '.tmp', filename)
+
+
+def read_pairs(filename) -> SynergyPairs:
+    """ Memory-maps the columns of a synergy pair file. """
+    with open(filename, 'rb') as f:
+        if f.read(len(PAIRS_MAGIC)) != PAIRS_MAGIC:
+            raise ValueError(f"{filename} is not a synergy pair file.")
+        length = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+        header = json.loads(f.read(length))
+    n = header['count']
+    offset = len(PAIRS_MAGIC) + 8 + length
+    columns: list[np.ndarray] = []
+    for dtype in ('<i4', '<i4', '<f4', '<f4')[:4 if header['weighted'] else 3]:
+        if n:
+            columns.append(np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(n,)))
+        else:
+            columns.append(np.zeros(0, dtype=dtype))
+        offset += 4 * n
+    weight = columns[3] if header['weighted'] else None
+    return SynergyPairs(header['names'], columns[0], columns[1], columns[2], weight)
 
 
-def calculate_npmi(decklists, epsilon=1e-2):
-    occur = defaultdict(int)
-    co_occur = defaultdict(int)
+def synergy_loader(dataset: SynergyDataset, batch_size: int, shuffle=False) -> DataLoader:
+    """ A DataLoader which fetches each batch of the dataset with a single index list. """
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last=False), batch_size=None)
+
+
+def encode_decklists(decklists) -> tuple[list[np.ndarray], list[str]]:
+    """ Maps each decklist to a sorted array of distinct card ids, resolving every
+        name only once. Returns the encoded decks and the card name of each id. """
+    ids: dict[str, int] = {}
+    resolved: dict[str, int] = {}
+    decks = []
     for decklist in progressbar(decklists):
-        count = len(decklist)
-        keys = list(decklist.keys())
-        for i in range(count):
-            c1 = keys[i]
-            if c1 == "Unknown Card":
+        if decklist is None:
+            continue
+        deck = set()
+        for name in decklist:
+            if name == "Unknown Card":
                 continue
-            occur[c1] = occur[c1] + 1
-            for j in range(i+1, count):
-                c2 = keys[j]
-                if c2 == "Unknown Card":
-                    continue
-                try:
-                    _card1 = card.get_card(c1)
-                except KeyError:
-                    c1 = card.find_name(c1)
-                try:
-                    _card2 = card.get_card(c2)
-                except KeyError:
-                    c2 = card.find_name(c2)
-                key = '|'.join(sorted((c1, c2)))
-                co_occur[key] = co_occur[key] + 1
+            if name not in resolved:
+                resolved[name] = ids.setdefault(resolve_name(name), len(ids))
+            deck.add(resolved[name])
+        decks.append(np.array(sorted(deck), dtype=np.int32))
+    return decks, list(ids)
 
-    data = []
-    n = len(decklists)
-    for k, v in co_occur.items():
-        c1, c2 = k.split('|')
-        p_c1 = occur[c1] / n
-        p_c2 = occur[c2] / n
-        p_co_occur = v / n + epsilon
-        p_independent = p_c1 * p_c2 + epsilon
-        npmi = math.log(p_co_occur / p_independent) / -math.log(p_co_occur)
-        data.append((c1, c2, npmi))
-    return data
+
+def npmi_matrix(decks: list[np.ndarray], n_cards: int, epsilon=1e-2):
+    """ Computes the NPMI of every pair of cards that occur together in a deck.
+        Occurrences come from the deck x card incidence matrix X, co-occurrences from X^T X.
+        Returns the arrays (first card id, second card id, npmi), with first < second. """
+    n = len(decks)
+    indptr = np.cumsum([0] + [len(d) for d in decks])
+    indices = np.concatenate(decks) if decks else np.zeros(0, dtype=np.int32)
+    incidence = sparse.csr_matrix(
+        (np.ones(len(indices), dtype=np.int32), indices, indptr), shape=(n, n_cards))
+    occur = np.asarray(incidence.sum(axis=0)).ravel()
+    co_occur = sparse.triu(incidence.T @ incidence, k=1).tocoo()
+    p_c1 = occur[co_occur.row] / n
+    p_c2 = occur[co_occur.col] / n
+    p_co_occur = co_occur.data / n + epsilon
+    p_independent = p_c1 * p_c2 + epsilon
+    npmi = np.log(p_co_occur / p_independent) / -np.log(p_co_occur)
+    return co_occur.row, co_occur.col, npmi
 
 
 def create_positive_data(decklists):
@@ -112,60 +179,43 @@ def create_negative_data(decklists, num=1000):
     return data
 
 
-def write_deck_data(decklists, train_file=TRAIN_SYNERGY, test_file=TEST_SYNERGY, train_rate=0.7):
-    # positive_data = create_positive_data(decklists)
-    # random.shuffle(positive_data)
-    # negative_data = create_negative_data(decklists, num=len(positive_data))
-    # # neg data is already randomly generated so no need to shuffle
-    # psplit = int(len(positive_data)*train_rate)
-    # nsplit = int(len(negative_data)*train_rate)
-    #
-    # os.makedirs(SYNERGYDIR, exist_ok=True)
-    #
-    # with open(train_file, 'w') as f:
-    #     pd = positive_data[:psplit]
-    #     nd = negative_data[:nsplit]
-    #     d = pd + nd
-    #     writer = csv.writer(f)
-    #     writer.writerows(d)
-    #
-    # with open(test_file, 'w') as f:
-    #     pd = positive_data[psplit:]
-    #     nd = negative_data[nsplit:]
-    #     d = pd + nd
-    #     writer = csv.writer(f)
-    #     writer.writerows(d)
-    pmi_data = calculate_npmi(decklists)
-    positive = 0
-    positive_printed = 0
-    neutral = 0
-    negative = 0
-    negative_printed = 0
-    max = 0.0
-    min = 0.0
-    for c1, c2, v in pmi_data:
-        if v > 0.2:
-            positive += 1
-            if v > max:
-                max = v
-            if positive_printed < 10:
-                print(f"Positive: {c1} | {c2}")
-                positive_printed += 1
-        elif v < -0.2:
-            negative += 1
-            if v < min:
-                min = v
-            if negative_printed < 10:
-                print(f"Negative: {c1} | {c2}")
-                negative_printed += 1
-        else:
-            neutral += 1
-    total = positive + neutral + negative
-    print(f"Positive: {positive} ({100*positive/total:.2f}%)")
+def write_deck_data(decklists, train_file=TRAIN_SYNERGY, test_file=TEST_SYNERGY, train_rate=0.7, names=None,
+                    threshold=0.2):
+    """ Writes the pairs of cards whose NPMI is above threshold as synergetic (1) and below
+        -threshold as not (0), split between the train and test files in the synergy pair
+        format. If names is given, the decklists are arrays of card ids into names. """
+    if names is None:
+        decks, names = encode_decklists(decklists)
+    else:
+        decks = decklists
+    c1, c2, npmi = npmi_matrix(decks, len(names))
+    positive = np.flatnonzero(npmi > threshold)
+    negative = np.flatnonzero(npmi < -threshold)
+
+    total = len(npmi)
+    neutral = total - len(positive) - len(negative)
+    for i in positive[:10]:
+        print(f"Positive: {names[c1[i]]} | {names[c2[i]]}")
+    for i in negative[:10]:
+        print(f"Negative: {names[c1[i]]} | {names[c2[i]]}")
+    print(f"Positive: {len(positive)} ({100*len(positive)/total:.2f}%)")
     print(f"Neutral : {neutral} ({100*neutral/total:.2f}%)")
-    print(f"Negative: {negative} ({100*negative/total:.2f}%)")
-    print(f"Max: {max}")
-    print(f"Min: {min}")
+    print(f"Negative: {len(negative)} ({100*len(negative)/total:.2f}%)")
+    print(f"Max: {max(npmi.max(initial=0.0), 0.0)}")
+    print(f"Min: {min(npmi.min(initial=0.0), 0.0)}")
+
+    rng = np.random.default_rng()
+    rng.shuffle(positive)
+    rng.shuffle(negative)
+    psplit = int(len(positive)*train_rate)
+    nsplit = int(len(negative)*train_rate)
+    os.makedirs(os.path.dirname(train_file), exist_ok=True)
+    os.makedirs(os.path.dirname(test_file), exist_ok=True)
+    for filename, pos, neg in ((train_file, positive[:psplit], negative[:nsplit]),
+                               (test_file, positive[psplit:], negative[nsplit:])):
+        rows = np.concatenate((pos, neg))
+        label = np.concatenate((np.ones(len(pos)), np.zeros(len(neg)))).astype(np.float32)
+        write_pairs(filename, names, c1[rows], c2[rows], label)
 
 
 def card_encode(cardname, embeddings, cv):
@@ -175,16 +225,16 @@ def card_encode(cardname, embeddings, cv):
     except KeyError:
         c = card.get_card(card.find_name(cardname))
     emb1 = embeddings[c.card_faces[0].name]
-    cmc1 = torch.from_numpy(cv[c.card_faces[0].name]).float()
+    cmc1 = torch.tensor(cv[c.card_faces[0].name]).float()
     emb2 = torch.tensor(64 * [0.0])
     cmc2 = torch.tensor([0.0])
     if c.layout in ["split", "modal_dfc", "adventure"]:
         emb2 = embeddings[c.card_faces[1].name]
-        cmc2 = torch.from_numpy(cv[c.card_faces[1].name]).float()
+        cmc2 = torch.tensor(cv[c.card_faces[1].name]).float()
         layout_tensor = torch.tensor([1.0, 0.0])
     elif c.layout in ["transfrom", "flip", "battle"]:
         emb2 = embeddings[c.card_faces[1].name]
-        cmc2 = torch.from_numpy(cv[c.card_faces[1].name]).float()
+        cmc2 = torch.tensor(cv[c.card_faces[1].name]).float()
         layout_tensor = torch.tensor([0.0, 1.0])
     else:
         layout_tensor = torch.tensor([0.0, 0.0])
@@ -194,58 +244,18 @@ def card_encode(cardname, embeddings, cv):
 def read_deck_data(filename):
     # This code assumes that the cards are already loaded.
     embeddings = load_card_embedding()
-    # cv = props_vector(card.get_cards(), props=['cmc'], backface=False)
-    with open(filename, 'r') as f:
-        reader = csv.reader(f)
-        # rows = [row for row in reader]
-        deck_data = [(
-            embeddings[card.get_card(c1).card_faces[0].name],
-            embeddings[card.get_card(c2).card_faces[0].name],
-        # card_encode(c1, embeddings, cv) + card_encode(c2, embeddings, cv),
-            torch.tensor(int(syn)).float())
-            for c1, c2, syn in progressbar(reader)]
-    # print("Point 1")
-    deck_data = util.transpose(deck_data)
-    # print("Point 2")
-    return SynergyDataset(deck_data[0], deck_data[1], deck_data[2])
-
-
-def deck_task(filepath):
-    if os.path.isfile(filepath):
-        with open(filepath, 'r') as f:
-            deck = parse_decklist(f.read(), limit=60)
-            lands = []
-            for name in deck:
-                try:
-                    c = card.get_card(name)
-                except KeyError:
-                    c = card.get_card(card.find_name(name))
-                if not is_nonland(c):
-                    lands.append(name)
-            deck.pop(lands, None)
-            return deck
+    pairs = read_pairs(filename)
+    matrix = embeddings.gather([card.get_card(name).card_faces[0].name for name in pairs.names])
+    return SynergyDataset(matrix, pairs.c1, pairs.c2, pairs.value)
 
 
-def create_deck_data(set_code, train_file=TRAIN_SYNERGY, test_file=TEST_SYNERGY, train_rate=0.7):
+def create_deck_data(set_code, train_file=TRAIN_SYNERGY, test_file=TEST_SYNERGY, train_rate=0.7, processes=None):
     card.load_cards(data.load(no_download=True))
-    decklists = []
-    decklist_dir = '../data/decklists/standard'
-
-    with ThreadPoolExecutor(max_workers=64) as executor:
-        # setdirs = [ os.path.join(decklist_dir, s) for s in os.listdir(decklist_dir) if SETS[s].date <= SETS[set_code].date ]
-        futures = []
-        for setdir in os.listdir(decklist_dir):
-            if SETS[setdir].date <= SETS[set_code].date:
-                setdir = os.path.join(decklist_dir, setdir)
-                for deckdir in os.listdir(setdir):
-                    deckdir = os.path.join(setdir, deckdir)
-                    # for deck in islice(os.listdir(deckdir), 5):
-                    for deck in os.listdir(deckdir):
-                        filepath = os.path.join(deckdir, deck)
-                        futures.append(executor.submit(deck_task, filepath))
-        for f in progressbar(as_completed(futures)):
-            decklists.append(f.result())
-    write_deck_data(decklists, train_file, test_file, train_rate)
+    set_codes = [s for s in os.listdir(os.path.join(DECKLISTDIR, 'standard')) if SETS[s].date <= SETS[set_code].date]
+    # Only decklists that aren't in the corpus yet are parsed
+    corpus = ingest('standard', set_codes, processes=processes)
+    decklists = corpus.decks_until(set_code)
+    write_deck_data(decklists, train_file, test_file, train_rate, names=corpus.vocabulary.names)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,75 @@
+""" embedding_store - Card embeddings as one float32 matrix with a row per face name
+
+The matrix is saved as a .npy file and memory-mapped when loaded, so loading is
+instant and processes reading the same store share its pages. The face name of
+each row is saved beside it in a JSON index, along with a hash of the inputs each
+row was computed from and a checksum of the model which computed them, so that
+only the rows of new or changed faces need to be computed again. """
+
+import json
+import os
+
+import numpy as np
+import torch
+
+
+class EmbeddingStore:
+    def __init__(self, names: list[str], matrix: np.ndarray, hashes: list[str] | None = None,
+                 model: str | None = None):
+        self.names = names
+        self.index = {name: i for i, name in enumerate(names)}
+        self.matrix = matrix
+        self.hashes = hashes
+        self.model = model
+
+    def is_current(self, name: str, face_hash: str) -> bool:
+        """ Whether the face's row was computed from inputs with the given hash. """
+        return self.hashes is not None and name in self.index and self.hashes[self.index[name]] == face_hash
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.index
+
+    def __getitem__(self, name: str) -> torch.Tensor:
+        return torch.tensor(self.matrix[self.index[name]])
+
+    def keys(self):
+        return self.index.keys()
+
+    def rows(self, names) -> np.ndarray:
+        """ Returns the row of each of the given face names. """
+        return np.fromiter((self.index[name] for name in names), dtype=np.int64)
+
+    def gather(self, names) -> torch.Tensor:
+        """ Returns the embeddings of the given face names as a matrix, one row per name. """
+        return torch.from_numpy(self.matrix[self.rows(names)])
+
+    @staticmethod
+    def save(path: str, names: list[str], matrix, hashes: list[str] | None = None, model: str | None = None) -> None:
+        """ Saves embeddings to path.npy and their face names, input hashes
+            and model checksum to path.json. """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        np.save(path + '.tmp.npy', np.asarray(matrix, dtype=np.float32))
+        with open(path + '.json.tmp', 'w') as f:
+            json.dump({'names': list(names), 'hashes': hashes and list(hashes), 'model': model}, f)
+        os.replace(path + '.tmp.npy', path + '.npy')
+        os.replace(path + '.json.tmp', path + '.json')
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(path + '.npy') and os.path.exists(path + '.json')
+
+    @classmethod
+    def load(cls, path: str) -> 'EmbeddingStore':
+        """ Loads a store saved by save. Stores saved before input hashes were kept
+            index their rows with a plain list of names; they load without hashes
+            or model checksum, so none of their rows count as current. """
+        with open(path + '.json', 'r') as f:
+            index = json.load(f)
+        if isinstance(index, list):
+            index = {'names': index, 'hashes': None, 'model': None}
+        return cls(index['names'], np.load(path + '.npy', mmap_mode='r'), index['hashes'], index['model'])
@@ -10,9 +10,10 @@ from progressbar import progressbar
 from numeromancy.preprocessing import CARD_TEXTS, props_vector, read_text
 from .card_embedding import CardEmbedding
 from .cost_model import CARD_EMBEDDING, MODELDIR
-from .deck_data import read_deck_data, TRAIN_SYNERGY, TEST_SYNERGY
+from .deck_data import read_deck_data, synergy_loader, TRAIN_SYNERGY, TEST_SYNERGY
 import numeromancy.card as card
 import numeromancy.data as data
+from numeromancy.util import model_checksum
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 SYNERGY_CLASSIFIER = os.path.join(MODELDIR, 'synergy_classifier')
@@ -36,11 +37,31 @@ def load_model(model_file=SYNERGY_CLASSIFIER):
     return model
 
 
+def score_synergy(model, candidates, partners, batch_size=65536):
+    """ Scores every candidate embedding against every partner embedding.
+        Returns a (len(candidates), len(partners)) matrix of synergy logits.
+        Each pair is fed to the model as (candidate, partner), and all the pairs
+        are scored in as few forward passes of batch_size pairs as possible. """
+    candidates = candidates.to(device)
+    partners = partners.to(device)
+    n, m = len(candidates), len(partners)
+    scores = torch.empty((n, m), device=device)
+    rows = max(1, batch_size // max(m, 1))
+    with torch.no_grad():
+        for i in range(0, n, rows):
+            cand = candidates[i:i+rows]
+            pairs = torch.cat((
+                cand.unsqueeze(1).expand(-1, m, -1),
+                partners.unsqueeze(0).expand(len(cand), -1, -1)), dim=2)
+            scores[i:i+rows] = model(pairs.reshape(len(cand) * m, -1)).reshape(len(cand), m)
+    return scores
+
+
 def train_model(model, train_file=TRAIN_SYNERGY, model_file=SYNERGY_CLASSIFIER, epochs=100, batch_size=16384):
     card.load_cards(data.load(no_download=True))
     cards = card.get_cards()
 
-    train_loader = DataLoader(read_deck_data(train_file), batch_size=batch_size, shuffle=True)
+    train_loader = synergy_loader(read_deck_data(train_file), batch_size, shuffle=True)
 
     optimizer = torch.optim.Adam(
         list(model.parameters()),
@@ -68,7 +89,7 @@ def test_model(model, test_file=TEST_SYNERGY, batch_size=16384):
     card.load_cards(data.load(no_download=True))
     cards = card.get_cards()
 
-    test_loader = DataLoader(read_deck_data(test_file), batch_size=batch_size, shuffle=True)
+    test_loader = synergy_loader(read_deck_data(test_file), batch_size, shuffle=True)
     with torch.no_grad():
         hit = 0
         all = 0
@@ -88,7 +109,7 @@ if __name__ == '__main__':
     card.load_cards(data.load(no_download=True))
     cards = card.get_cards()
 
-    train_loader = DataLoader(read_deck_data(TRAIN_SYNERGY), batch_size=batch_size, shuffle=True)
+    train_loader = synergy_loader(read_deck_data(TRAIN_SYNERGY), batch_size, shuffle=True)
 
     clf = nn.Sequential(
         nn.Linear(128, 64),
@@ -120,7 +141,7 @@ if __name__ == '__main__':
     clf.eval()
     del train_loader
 
-    test_loader = DataLoader(read_deck_data(TEST_SYNERGY), batch_size=batch_size)
+    test_loader = synergy_loader(read_deck_data(TEST_SYNERGY), batch_size)
     with torch.no_grad():
         hit = 0
         all = 0
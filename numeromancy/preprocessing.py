@@ -24,8 +24,15 @@ import sys
 import os
 import re
 import csv
+import hashlib
+import json
+import multiprocessing
 import random
-from collections.abc import Collection, Iterable
+from collections.abc import Callable, Collection, Iterable
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+from typing import NamedTuple
 import numpy as np
 
 from nltk.tokenize import word_tokenize, sent_tokenize
@@ -33,6 +40,7 @@ from nltk.stem import PorterStemmer
 from nltk.corpus import stopwords
 
 import networkx as nx
+from progressbar import progressbar
 import nbne
 
 import numeromancy.card as card
@@ -70,22 +78,41 @@ def remove_bracket_spaces(text: str) -> str:
     return re.sub(r'\{\s+([A-Za-z0-9])\s+\}', r'{\1}', text)
 
 
-def preprocess_text(cards: Iterable[card.Card], filename=CARD_TEXTS) -> None:
+def tokenize_rules_text(rules_text: str) -> str:
+    """ Splits rules text into sentences and words with NLTK, keeping one line per line. """
+    texts = []
+    if rules_text:
+        for line in rules_text.split('\n'):
+            text = []
+            for s in sent_tokenize(line):
+                words = word_tokenize(s)
+                text.append(remove_bracket_spaces(' '.join(words)))
+            texts.append(' '.join(text))
+    return '\n'.join(texts)
+
+
+def _tokenize_chunk(faces: list[tuple[str, str]]) -> list[tuple[str, str]]:
+    return [(name, tokenize_rules_text(rules_text)) for name, rules_text in faces]
+
+
+def preprocess_text(cards: Iterable[card.Card], filename=CARD_TEXTS, parallel=False, processes=None,
+                    chunk_size=256) -> None:
+    """ Writes the tokenized rules text of every face to a CSV.
+        If parallel is set, faces are tokenized chunk_size at a time across processes
+        (the number of CPUs, unless processes is given). Rows are written in the same
+        order, and are identical to those of a serial run. """
     _logger.info("Preprocessing card texts...")
+    faces = [(face.name, face.rules_text) for c in cards for face in c.card_faces]
+    chunks = [faces[i:i+chunk_size] for i in range(0, len(faces), chunk_size)]
     with open(filename, 'w', encoding='UTF8') as f:
-        writer = csv.writer(f);
-        for card in card.CardProgressBar(cards):
-            for face in card.card_faces:
-                texts = []
-                if face.rules_text:
-                    for line in face.rules_text.split('\n'):
-                        text = []
-                        for s in sent_tokenize(line):
-                            words = word_tokenize(s)
-                            text.append(remove_bracket_spaces(' '.join(words)))
-                        texts.append(' '.join(text))
-                all_texts = '\n'.join(texts)
-                writer.writerow((face.name, all_texts))
+        writer = csv.writer(f)
+        if parallel:
+            with multiprocessing.Pool(processes) as pool:
+                for rows in progressbar(pool.imap(_tokenize_chunk, chunks), max_value=len(chunks)):
+                    writer.writerows(rows)
+        else:
+            for chunk in progressbar(chunks):
+                writer.writerows(_tokenize_chunk(chunk))
 
 
 def write_augmented(filename: str, rows: list[list[str]], ratio: float = 0.3):
@@ -127,6 +154,11 @@ numerical_props = ['power', 'toughness', 'loyalty', 'defense', 'cmc']
 list_props = ['supertypes', 'cardtypes', 'subtypes', 'colors']
 feature_props = [x for x in numerical_props + list_props if x != 'cmc']
 NBNE_DIMENSIONS = 10
+# Faces sharing a value are all linked in the property graph, unless more than
+# PROPERTY_BUCKET_CAP faces share it. Each of those is then linked to as many
+# other faces sharing it, picked at random with PROPERTY_GRAPH_SEED.
+PROPERTY_BUCKET_CAP = 256
+PROPERTY_GRAPH_SEED = 0
 
 
 def face_count(cards: Collection[card.Card]) -> int:
@@ -146,11 +178,44 @@ def preprocess_numerical_prop(cards: Collection[card.Card], prop: str, props_dir
     _logger.info(f'Preprocessing the numerical property {prop}...')
     with open(os.path.join(props_dir, f'{prop}.model'), 'w') as f:
         print(face_count(cards), 1, file=f)
-        for card in card.CardProgressBar(cards):
-            for face in card.card_faces:
+        for c in card.CardProgressBar(cards):
+            for face in c.card_faces:
                 print(face.name, to_number(getattr(face, prop)), file=f)
 
 
+def property_edges(faces: list, prop: str, cap: int = PROPERTY_BUCKET_CAP,
+                   seed: int = PROPERTY_GRAPH_SEED) -> tuple[np.ndarray, np.ndarray]:
+    """ Finds the pairs of faces that share a value of a list property through an inverted
+        index from each value to the faces which have it. Returns the indices of the faces
+        of each pair as two arrays, each pair once, with the first index lower. """
+    buckets = dict()
+    for i, face in enumerate(faces):
+        for v in set(getattr(face, prop)):
+            buckets.setdefault(v, []).append(i)
+    firsts, seconds = [], []
+    for b, v in enumerate(sorted(buckets, key=str)):
+        bucket = np.array(buckets[v], dtype=np.int64)
+        k = len(bucket)
+        if k < 2:
+            continue
+        if k <= cap:
+            i, j = np.triu_indices(k, 1)
+        else:
+            rng = np.random.default_rng([seed, b])
+            i = np.repeat(np.arange(k), cap)
+            j = rng.integers(0, k - 1, size=k * cap)
+            j += j >= i  # Skip the face itself
+        firsts.append(bucket[i])
+        seconds.append(bucket[j])
+    if not firsts:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    first = np.concatenate(firsts)
+    second = np.concatenate(seconds)
+    low, high = np.minimum(first, second), np.maximum(first, second)
+    pairs = np.unique(low * len(faces) + high)
+    return pairs // len(faces), pairs % len(faces)
+
+
 def preprocess_list_prop(cards: Collection[card.Card], prop: str, props_dir: str | os.PathLike) -> None:
     _logger.info(f'Preprocessing the list property {prop}...')
     values = set()
@@ -166,18 +231,13 @@ def preprocess_list_prop(cards: Collection[card.Card], prop: str, props_dir: str
 
     if dimensions > NBNE_DIMENSIONS:
         _logger.info(f'Creating the property graph for property {prop}...')
+        faces = list({f.name: f for c in cards for f in c.card_faces}.values())
+        names = [f.name for f in faces]
+        first, second = property_edges(faces, prop)
+        _logger.info(f'Property graph for {prop} has {len(first)} edges.')
         graph = nx.Graph()
-        for c1 in card.CardProgressBar(cards):
-            for f1 in c1.card_faces:
-                key1 = f1.name
-                property = getattr(f1, prop)
-                graph.add_node(key1)
-                for c2 in cards:
-                    for f2 in c2.card_faces:
-                        key2 = f2.name
-                        property2 = getattr(f2, prop)
-                        if key1 != key2 and not set(property).isdisjoint(property2):
-                            graph.add_edge(key1, key2)
+        graph.add_nodes_from(names)
+        graph.add_edges_from(zip((names[i] for i in first.tolist()), (names[j] for j in second.tolist())))
         nbne.train_model(graph, NBNE_DIMENSIONS, output_file=os.path.join(props_dir, f'{prop}.model'), embedding_dimension=NBNE_DIMENSIONS)
     else:
         _logger.info(f'Creating sparse vectors for property {prop}...')
@@ -195,47 +255,361 @@ def preprocess_props(cards: Collection[card.Card], props_dir: str | os.PathLike
         preprocess_numerical_prop(cards, prop, props_dir)
     for prop in list_props:
         preprocess_list_prop(cards, prop, props_dir)
+    convert_props(numerical_props + list_props, props_dir)
 
 
-def read_prop(cards: Iterable[card.Card], prop: str, props_dir: str | os.PathLike = PROPSDIR) -> dict[str, np.ndarray]:
-    with open(os.path.join(props_dir, f'{prop}.model'), 'r') as f:
+def parse_prop_model(filename) -> tuple[list[str], np.ndarray]:
+    """ Parses a word2vec-style text .model file into its face names and their vectors. """
+    with open(filename, 'r') as f:
         header = f.readline().split()
         lines, dims = int(header[0]), int(header[1])
-        vectors = dict()
-        for _ in range(lines):
+        names = []
+        vectors = np.zeros((lines, dims))
+        for i in range(lines):
             line = f.readline().split()
-            cardname = ' '.join(line[:-dims])
-            vector = np.asfarray(line[-dims:])
-            vectors[cardname] = vector
+            names.append(' '.join(line[:-dims]))
+            vectors[i] = np.array(line[-dims:], dtype=float)
+    return names, vectors
+
+
+def read_prop(cards: Iterable[card.Card], prop: str, props_dir: str | os.PathLike = PROPSDIR) -> dict[str, np.ndarray]:
+    names, vectors = parse_prop_model(os.path.join(props_dir, f'{prop}.model'))
+    vectors = dict(zip(names, vectors))
+    dims = len(next(iter(vectors.values()))) if vectors else 0
     vectors.update((f.name, np.zeros((dims,))) for c in cards for f in c.card_faces if f.name not in vectors)
     return vectors
 
 
-def props_vector(cards, props = feature_props, backface = True):
-    prop_dicts = { p: read_prop(cards, p) for p in props }
-    return { f.name: np.concatenate([prop_dicts[p][f.name] for p in props])
-        for c in cards for f in c.card_faces
-        if backface or not (c.layout in ['transform', 'flip', 'battle'] and f == c.card_faces[1]) }
+class PropStore:
+    """ The prop vectors of card faces in binary form: props.json holds the face name
+        index shared by every prop, and <prop>.npy a float32 matrix whose rows follow
+        that index. A prop's matrix is converted from its .model file whenever the file
+        changes, and is memory-mapped. The index is only ever appended to, so matrices
+        converted earlier may have fewer rows than it; the missing rows are zeros. """
+
+    def __init__(self, props_dir: str | os.PathLike = PROPSDIR):
+        self.props_dir = props_dir
+        self.index_file = os.path.join(props_dir, 'props.json')
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'r') as f:
+                index = json.load(f)
+        else:
+            index = {'faces': [], 'sources': {}}
+        self.faces: list[str] = index['faces']
+        self.sources: dict[str, list[int] | None] = index['sources']
+        self.index = {name: i for i, name in enumerate(self.faces)}
+        self._matrices: dict[str, np.ndarray] = {}
+
+    def _source(self, prop: str) -> list[int] | None:
+        path = os.path.join(self.props_dir, f'{prop}.model')
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def save(self) -> None:
+        with open(self.index_file + '.tmp', 'w') as f:
+            json.dump({'faces': self.faces, 'sources': self.sources}, f)
+        os.replace(self.index_file + '.tmp', self.index_file)
+
+    def convert(self, prop: str) -> None:
+        """ Converts the prop's .model file into its binary matrix. """
+        source = self._source(prop)
+        names, vectors = parse_prop_model(os.path.join(self.props_dir, f'{prop}.model'))
+        for name in names:
+            if name not in self.index:
+                self.index[name] = len(self.faces)
+                self.faces.append(name)
+        matrix = np.zeros((len(self.faces), vectors.shape[1]), dtype=np.float32)
+        matrix[[self.index[name] for name in names]] = vectors
+        path = os.path.join(self.props_dir, f'{prop}.npy')
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, matrix)
+        os.replace(path + '.tmp', path)
+        self.sources[prop] = source
+        self._matrices.pop(prop, None)
+        self.save()
+
+    def matrix(self, prop: str) -> np.ndarray:
+        """ Memory-maps the prop's matrix, converting it first if it's missing or stale. """
+        matrix = self._matrices.get(prop)
+        if matrix is None:
+            path = os.path.join(self.props_dir, f'{prop}.npy')
+            source = self._source(prop)
+            if source is not None and (source != self.sources.get(prop) or not os.path.exists(path)):
+                self.convert(prop)
+            matrix = np.load(path, mmap_mode='r')
+            self._matrices[prop] = matrix
+        return matrix
+
+    def gather(self, names: list[str], props) -> np.ndarray:
+        """ Returns the concatenated vectors of the props for the named faces, one row per
+            name. Faces which a prop has no vector for get zeros, like read_prop does. """
+        # Converting a prop may add faces to the index, so it's done first
+        matrices = [self.matrix(prop) for prop in props]
+        rows = np.fromiter((self.index.get(name, -1) for name in names), dtype=np.int64, count=len(names))
+        blocks = []
+        for matrix in matrices:
+            block = np.zeros((len(names), matrix.shape[1]), dtype=np.float32)
+            found = (rows >= 0) & (rows < len(matrix))
+            block[found] = matrix[rows[found]]
+            blocks.append(block)
+        if not blocks:
+            return np.zeros((len(names), 0), dtype=np.float32)
+        return np.concatenate(blocks, axis=1)
+
+
+class PropVectors:
+    """ The concatenated prop vectors of card faces, as returned by props_vector:
+        one row of matrix per face, looked up by face name like a dict. """
+
+    def __init__(self, names: list[str], matrix: np.ndarray):
+        self.names = names
+        self.index = {name: i for i, name in enumerate(names)}
+        self.matrix = matrix
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.index
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.matrix[self.index[name]]
+
+    def keys(self):
+        return self.index.keys()
+
+    def gather(self, names) -> np.ndarray:
+        """ Returns the vectors of the named faces as a matrix, one row per name. """
+        return self.matrix[np.fromiter((self.index[name] for name in names), dtype=np.int64)]
+
+
+def _props_stamp(props, props_dir) -> tuple:
+    """ The modification times of the files the props are read from. """
+    stamp = []
+    for prop in props:
+        for ext in ('.model', '.npy'):
+            path = os.path.join(props_dir, prop + ext)
+            stamp.append(os.stat(path).st_mtime_ns if os.path.exists(path) else None)
+    return tuple(stamp)
+
+
+PROPS_VECTOR_CACHE_SIZE = 8
+_props_vector_cache: dict[tuple, PropVectors] = {}
+
+def props_vector(cards, props = feature_props, backface = True, props_dir = PROPSDIR) -> PropVectors:
+    """ Returns the concatenated vectors of the props for every face of the cards (except
+        the back faces of transforming cards, unless backface is set).
+        Results are memoized per process by the props, backface, the card pool and the
+        modification times of the prop files, and shared between callers, so their
+        matrix is read-only. """
+    props = tuple(props)
+    pool = cards if isinstance(cards, frozenset) else frozenset(cards)
+    key = (props, backface, pool, os.fspath(props_dir), _props_stamp(props, props_dir))
+    vectors = _props_vector_cache.get(key)
+    if vectors is None:
+        names = list(dict.fromkeys(
+            f.name for c in cards for f in c.card_faces
+            if backface or not (c.layout in ['transform', 'flip', 'battle'] and f == c.card_faces[1])))
+        vectors = PropVectors(names, PropStore(props_dir).gather(names, props))
+        vectors.matrix.setflags(write=False)
+        if len(_props_vector_cache) >= PROPS_VECTOR_CACHE_SIZE:
+            del _props_vector_cache[next(iter(_props_vector_cache))]
+        _props_vector_cache[key] = vectors
+    return vectors
 
 
 def preprocess_layout(cards: Collection[card.Card], props_dir: str | os.PathLike = PROPSDIR) -> None:
     with open(os.path.join(props_dir, 'layout.model'), 'w') as f:
         print(len(cards), len(layouts), file=f)
-        for card in card.CardProgressBar(cards):
-            if card.layout in ['split', 'modal_dfc', 'adventure']:
+        for c in card.CardProgressBar(cards):
+            if c.layout in ['split', 'modal_dfc', 'adventure']:
                 vector = [1 if l == 'choose' else 0 for l in layouts]
-            elif card.layout in ['transform', 'flip', 'battle']:
+            elif c.layout in ['transform', 'flip', 'battle']:
                 vector = [1 if l == 'transform' else 0 for l in layouts]
             else:
                 vector = [1 if l == 'single' else 0 for l in layouts]
-            print(card.name, *vector, file=f)
-
-
-def preprocess_all(cards: Collection[card.Card]) -> None:
-    preprocess_layout(cards)
-    preprocess_text(cards)
-    split_train_texts()
-    preprocess_props(cards)
+            print(c.name, *vector, file=f)
+
+
+def convert_props(props, props_dir: str | os.PathLike = PROPSDIR) -> None:
+    """ Converts the props whose .model files changed, or whose matrix is missing, into the PropStore. """
+    store = PropStore(props_dir)
+    for prop in props:
+        converted = os.path.exists(os.path.join(props_dir, f'{prop}.npy'))
+        if not converted or store.sources.get(prop) != store._source(prop):
+            store.convert(prop)
+
+
+STAMPSDIR = os.path.join(data.OUTPUTDIR, 'stamps')
+
+
+class Stage(NamedTuple):
+    """ A preprocessing step. run writes the outputs from the inputs, which are files
+        written by other stages, and from the given attributes of every card and face.
+        The version is part of the stamp, so bumping it reruns the stage after its
+        code changes. Concurrent stages may run in worker processes side by side. """
+    name: str
+    run: Callable[[], None]
+    outputs: tuple[str, ...]
+    inputs: tuple[str, ...] = ()
+    card_attrs: tuple[str, ...] = ()
+    face_attrs: tuple[str, ...] = ()
+    version: str = '1'
+    concurrent: bool = False
+
+
+def card_pool_hash(cards: Iterable[card.Card], card_attrs=(), face_attrs=()) -> str:
+    """ A hash of the names and given attributes of every card and face.
+        Cards are hashed in name order, since a pool such as card.get_cards()
+        is a set whose order changes from one process to the next. """
+    h = hashlib.sha256()
+    for c in sorted(cards, key=lambda c: c.name):
+        h.update(repr([c.name] + [getattr(c, a) for a in card_attrs]).encode())
+        for face in c.card_faces:
+            h.update(repr([face.name] + [getattr(face, a) for a in face_attrs]).encode())
+    return h.hexdigest()
+
+
+def _file_stamp(path) -> list[int] | None:
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def stage_stamp(stage: Stage, cards: Collection[card.Card]) -> dict:
+    """ What the stage's outputs are computed from: its version, the hash of
+        the card attributes it reads, and the modification times of its inputs. """
+    uses_cards = stage.card_attrs or stage.face_attrs
+    return {
+        'version': stage.version,
+        'cards': card_pool_hash(cards, stage.card_attrs, stage.face_attrs) if uses_cards else None,
+        'inputs': {path: _file_stamp(path) for path in stage.inputs},
+    }
+
+
+def is_fresh(stage: Stage, stamp: dict, stamps_dir=STAMPSDIR) -> bool:
+    """ Whether the stage last ran from the same stamp, and its outputs
+        are still the files it wrote then. """
+    path = os.path.join(stamps_dir, f'{stage.name}.json')
+    if not os.path.exists(path):
+        return False
+    with open(path, 'r') as f:
+        saved = json.load(f)
+    outputs = {output: _file_stamp(output) for output in stage.outputs}
+    return saved['stamp'] == stamp and saved['outputs'] == outputs and None not in outputs.values()
+
+
+def save_stamp(stage: Stage, stamp: dict, stamps_dir=STAMPSDIR) -> None:
+    path = os.path.join(stamps_dir, f'{stage.name}.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'stamp': stamp, 'outputs': {output: _file_stamp(output) for output in stage.outputs}}, f)
+    os.replace(path + '.tmp', path)
+
+
+_stages: dict[str, Stage] = {}
+
+
+def _run_stage(name: str) -> str:
+    _stages[name].run()
+    return name
+
+
+def run_stages(stages: list[Stage], cards: Collection[card.Card], force=False, parallel=False,
+               processes=None, stamps_dir=STAMPSDIR) -> list[str]:
+    """ Runs the stages which aren't fresh, or all of them if force is set, and returns
+        the names of those that ran. A stage runs once the stages writing its inputs are
+        done, so it sees their new outputs. If parallel is set, concurrent stages that are
+        ready together run in forked worker processes (the number of CPUs, unless processes
+        is given), while the others run in this process. """
+    global _stages
+    os.makedirs(stamps_dir, exist_ok=True)
+    writers = {path: s.name for s in stages for path in s.outputs}
+    done = set()
+    ran = []
+    pending = list(stages)
+    context = multiprocessing.get_context('fork')
+    try:
+        # Workers are forked, inheriting the stages and the loaded cards
+        _stages = {s.name: s for s in stages}
+        while pending:
+            ready = [s for s in pending
+                     if all(writers[p] in done for p in s.inputs if writers.get(p, s.name) != s.name)]
+            if not ready:
+                raise ValueError(f"Stages {', '.join(s.name for s in pending)} depend on each other.")
+            pending = [s for s in pending if s not in ready]
+            stamps = {}
+            for s in ready:
+                stamps[s.name] = stage_stamp(s, cards)
+                if not force and is_fresh(s, stamps[s.name], stamps_dir):
+                    _logger.info(f'Stage {s.name} is up to date.')
+                    done.add(s.name)
+            ready = [s for s in ready if s.name not in done]
+            workers = [s for s in ready if s.concurrent] if parallel else []
+            if len(workers) < 2:
+                workers = []
+            futures = []
+            with ProcessPoolExecutor(max_workers=processes, mp_context=context) if workers else nullcontext() as executor:
+                if executor is not None:
+                    futures = [executor.submit(_run_stage, s.name) for s in workers]
+                for s in ready:
+                    if s not in workers:
+                        _logger.info(f'Running stage {s.name}...')
+                        _run_stage(s.name)
+                        save_stamp(s, stamps[s.name], stamps_dir)
+                        done.add(s.name)
+                        ran.append(s.name)
+                for future in futures:
+                    name = future.result()
+                    save_stamp(_stages[name], stamps[name], stamps_dir)
+                    done.add(name)
+                    ran.append(name)
+    finally:
+        _stages = {}
+    return ran
+
+
+def preprocessing_stages(cards: Collection[card.Card], parallel=False, processes=None,
+                         props_dir: str | os.PathLike = PROPSDIR) -> list[Stage]:
+    """ The stages of preprocess_all. """
+    props = numerical_props + list_props
+    model = lambda prop: os.path.join(props_dir, f'{prop}.model')
+    graph = f'{NBNE_DIMENSIONS}-{PROPERTY_BUCKET_CAP}-{PROPERTY_GRAPH_SEED}'
+    stages = [
+        Stage('layout', partial(preprocess_layout, cards, props_dir), (model('layout'),),
+              card_attrs=('layout',)),
+        Stage('text', partial(preprocess_text, cards, CARD_TEXTS, parallel=parallel, processes=processes),
+              (CARD_TEXTS,), face_attrs=('rules_text',)),
+        # The split is random, so it's only made again when the card texts change
+        Stage('split', partial(split_train_texts, CARD_TEXTS, TRAIN_TEXTS, TEST_TEXTS), (TRAIN_TEXTS, TEST_TEXTS),
+              inputs=(CARD_TEXTS,)),
+    ]
+    for prop in numerical_props:
+        stages.append(Stage(prop, partial(preprocess_numerical_prop, cards, prop, props_dir), (model(prop),),
+                            face_attrs=(prop,), concurrent=True))
+    for prop in list_props:
+        stages.append(Stage(prop, partial(preprocess_list_prop, cards, prop, props_dir), (model(prop),),
+                            face_attrs=(prop,), version=f'1-{graph}', concurrent=True))
+    # The PropStore index is shared by every prop, so props are converted together after they're written
+    stages.append(Stage('prop_store', partial(convert_props, props, props_dir),
+                        (os.path.join(props_dir, 'props.json'),) + tuple(os.path.join(props_dir, f'{p}.npy') for p in props),
+                        inputs=tuple(model(p) for p in props)))
+    return stages
+
+
+def preprocess_all(cards: Collection[card.Card], force=False, parallel=False, processes=None,
+                   props_dir: str | os.PathLike = PROPSDIR, stamps_dir=STAMPSDIR) -> list[str]:
+    """ Runs the preprocessing stages whose outputs are out of date, or all of them
+        if force is set, and returns the names of those that ran. If parallel is set,
+        card texts are tokenized across processes and the props are preprocessed
+        side by side. """
+    return run_stages(preprocessing_stages(cards, parallel, processes, props_dir), cards,
+                      force, parallel, processes, stamps_dir)
 
 
 if __name__ == '__main__':
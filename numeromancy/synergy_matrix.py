@@ -0,0 +1,128 @@
+""" Precomputed synergy between every pair of cards legal in a format snapshot.
+
+The synergy model is deterministic at evaluation time and the legal card pool of
+a (format, set code) pair never changes, so the whole matrix can be computed once
+and looked up by the deck generator instead of running the model again. A matrix
+is only valid for the synergy model and card embeddings it was computed from, so
+both are part of its file name. """
+
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+from progressbar import progressbar
+
+import numeromancy.card as card
+import numeromancy.data as data
+from numeromancy.model import cost_model, synergy_model
+from numeromancy.model.embedding_store import EmbeddingStore
+from numeromancy.train_synergy import load_trained_synergy
+from numeromancy.format import get_legal_cards, date_and_code, find_previous_set
+
+SYNERGY_MATRIXDIR = os.path.join(data.OUTPUTDIR, 'synergy_matrix')
+
+
+class SynergyMatrix:
+    """ Synergy logits between the cards of a pool. Row i, column j is the synergy
+        of names[i] as a candidate against names[j] as a card in the deck. """
+
+    def __init__(self, names: list[str], scores: np.ndarray):
+        self.names = names
+        self.index = {name: i for i, name in enumerate(names)}
+        self.scores = scores
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.index
+
+    def rows(self, names) -> np.ndarray:
+        """ Returns the row indices of the given card names. """
+        return np.fromiter((self.index[name] for name in names), dtype=np.int64)
+
+    def column(self, rows: np.ndarray, name: str) -> np.ndarray:
+        """ Returns the synergy of each row's card against the named card. """
+        return np.asarray(self.scores[rows, self.index[name]], dtype=np.float32)
+
+
+def embedding_digest(embeddings: EmbeddingStore, faces: list[str]) -> str:
+    """ A digest of the embeddings of the faces: the checksum of the model which
+        computed them, and the hash of the inputs of each face's row. Stores saved
+        without hashes are digested from the rows themselves. """
+    h = hashlib.sha256()
+    h.update(str(embeddings.model).encode())
+    rows = embeddings.rows(faces)
+    if embeddings.hashes is None:
+        h.update(np.ascontiguousarray(embeddings.matrix[rows]).tobytes())
+    else:
+        for i in rows.tolist():
+            h.update(embeddings.hashes[i].encode())
+            h.update(b'\0')
+    return h.hexdigest()
+
+
+def pool_faces(format, date_or_code) -> tuple[list[str], list[str]]:
+    """ The names of the cards legal in the format snapshot, in matrix order,
+        and the names of the faces their embeddings are stored under. """
+    names = sorted(c.name for c in get_legal_cards(format, date_or_code))
+    return names, [card.get_card(name).card_faces[0].name for name in names]
+
+
+def matrix_path(format: str, set_code: str, checksum: str, embedding_key: str) -> str:
+    return os.path.join(SYNERGY_MATRIXDIR, f'{format.lower()}_{set_code.upper()}_{checksum[:16]}_{embedding_key[:16]}')
+
+
+def build_synergy_matrix(format, date_or_code, model=None, embeddings: EmbeddingStore | None = None,
+                         dtype=np.float32, batch_size=65536) -> SynergyMatrix:
+    """ Computes the synergy between every pair of cards legal in the format at the date
+        or release of the set, and saves it as a .npy file that can be memory-mapped.
+        The default model is the one create_deck uses for the same date, and the
+        default embeddings are the saved ones. """
+    date, set_code = date_and_code(date_or_code)
+    if model is None:
+        model = load_trained_synergy(find_previous_set(date, standard_only=True))
+    if embeddings is None:
+        embeddings = cost_model.load_card_embedding()
+    names, faces = pool_faces(format, date_or_code)
+    path = matrix_path(format, set_code, synergy_model.model_checksum(model), embedding_digest(embeddings, faces))
+    matrix = embeddings.gather(faces)
+
+    os.makedirs(SYNERGY_MATRIXDIR, exist_ok=True)
+    scores = np.lib.format.open_memmap(path + '.npy.tmp', mode='w+', dtype=dtype, shape=(len(names), len(names)))
+    rows = max(1, batch_size // max(len(names), 1))
+    for i in progressbar(range(0, len(names), rows)):
+        block = synergy_model.score_synergy(model, matrix[i:i+rows], matrix, batch_size=batch_size)
+        scores[i:i+rows] = block.cpu().numpy().astype(dtype)
+    scores.flush()
+    del scores
+    with open(path + '.json', 'w') as f:
+        json.dump(names, f)
+    os.replace(path + '.npy.tmp', path + '.npy')
+    return SynergyMatrix(names, np.load(path + '.npy', mmap_mode='r'))
+
+
+def load_synergy_matrix(format, date_or_code, model, embeddings: EmbeddingStore | None = None) -> SynergyMatrix | None:
+    """ Memory-maps the precomputed synergy matrix of the format snapshot, or returns
+        None if it hasn't been computed for this model and these embeddings
+        (the saved ones by default). """
+    _, set_code = date_and_code(date_or_code)
+    if embeddings is None:
+        embeddings = cost_model.load_card_embedding()
+    _, faces = pool_faces(format, date_or_code)
+    path = matrix_path(format, set_code, synergy_model.model_checksum(model), embedding_digest(embeddings, faces))
+    if not os.path.exists(path + '.npy'):
+        return None
+    with open(path + '.json', 'r') as f:
+        names = json.load(f)
+    return SynergyMatrix(names, np.load(path + '.npy', mmap_mode='r'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Precomputes the synergy matrix of a format snapshot.")
+    parser.add_argument('format', help="e.g. standard")
+    parser.add_argument('date_or_code', help="the code of a set, or a date, e.g. WAR or 03/05/2019")
+    parser.add_argument('--dtype', choices=['float32', 'float16'], default='float32')
+    args = parser.parse_args()
+    card.load_cards(data.load(no_download=True))
+    build_synergy_matrix(args.format, args.date_or_code, dtype=np.dtype(args.dtype))
@@ -9,8 +9,8 @@ import numeromancy.data as data
 def train_synergy(set_code, create_data=True):
     file_dir = os.path.join(SYNERGYDIR, set_code)
     os.makedirs(file_dir, exist_ok=True)
-    train_file = os.path.join(file_dir, 'train.csv')
-    test_file = os.path.join(file_dir, 'test.csv')
+    train_file = os.path.join(file_dir, 'train.pairs')
+    test_file = os.path.join(file_dir, 'test.pairs')
     model_file = os.path.join(file_dir, 'classifier.pt')
     if create_data:
         create_deck_data(set_code, train_file, test_file)
@@ -1,2 +1,14 @@
+import hashlib
+
+
 def transpose(m): # Transpose a list of list or any similar data structures
     return [list(m) for m in zip(*m)]
+
+
+def model_checksum(model):
+    """ A checksum of the model's weights, to tell apart caches computed by different models. """
+    h = hashlib.sha256()
+    for name, tensor in model.state_dict().items():
+        h.update(name.encode('UTF8'))
+        h.update(tensor.detach().cpu().numpy().tobytes())
+    return h.hexdigest()
@@ -8,7 +8,8 @@ sys.path.append(os.path.dirname(__file__))
 from collections import Counter
 import contextlib
 
-from numeromancy.deck_generator import generate_deck, is_nonland, is_in_color
+from numeromancy.deck_generator import generate_deck, is_nonland
+from numeromancy.card_pool import CardIndex
 import numeromancy.card as card
 import numeromancy.data as data
 
@@ -19,7 +20,8 @@ def load_card_data():
     card.load_cards(card_data)
     all_cards = card.get_cards()
     name_to_card = {c.name: c for c in all_cards}
-    return all_cards, name_to_card
+    index = CardIndex(all_cards)
+    return all_cards, name_to_card, index
 
 # Context manager to capture stdout
 @contextlib.contextmanager
@@ -103,7 +105,7 @@ def main():
     }
     
     # Load card data
-    all_cards, name_to_card = load_card_data()
+    all_cards, name_to_card, index = load_card_data()
     
     # Section 1: Starting Cards
     st.header("Starting Cards")
@@ -232,12 +234,7 @@ def main():
         if starting_cards == "":
             st.error("Please provide at least one valid starting card")
         # Get legal cards
-        legal_cards = {
-            c for c in all_cards
-            if c.legalities.get("modern") == "legal" 
-            and is_nonland(c)
-            and is_in_color(c, color_symbols)
-        }
+        legal_cards = index.candidates(index.legal("modern"), color_symbols)
         
         if not legal_cards:
             st.error("No legal cards found for selected colors")
@@ -0,0 +1,57 @@
+""" Tests for the stamps that let preprocess_all skip stages whose outputs are fresh. """
+
+from functools import partial
+from types import SimpleNamespace
+from typing import Any
+
+import pytest
+
+pytest.importorskip('nltk')
+pytest.importorskip('networkx')
+pytest.importorskip('nbne')
+
+import numeromancy.preprocessing as preprocessing
+
+
+def make_card(i: int) -> Any:
+    # Stands in for a card.Card, with only the attributes the stages read
+    face = SimpleNamespace(
+        name=f'Card {i}', rules_text=f'Draw {i} cards.', power=str(i % 4), toughness='1',
+        loyalty=None, defense=None, cmc=i % 6, supertypes=['Legendary'] if i % 2 else [],
+        cardtypes=['Creature'], subtypes=['Elf' if i % 3 else 'Human'], colors=['G'])
+    return SimpleNamespace(name=face.name, layout='normal', card_faces=[face])
+
+
+@pytest.fixture
+def preprocess_all(tmp_path, monkeypatch):
+    monkeypatch.setattr(preprocessing, 'CARD_TEXTS', str(tmp_path / 'card_texts.csv'))
+    monkeypatch.setattr(preprocessing, 'TRAIN_TEXTS', str(tmp_path / 'train_texts.csv'))
+    monkeypatch.setattr(preprocessing, 'TEST_TEXTS', str(tmp_path / 'test_texts.csv'))
+    # Tokenizing isn't under test, and would need the NLTK data
+    monkeypatch.setattr(preprocessing, 'tokenize_rules_text', lambda rules_text: rules_text)
+    props_dir = tmp_path / 'props'
+    props_dir.mkdir()
+    return partial(preprocessing.preprocess_all, props_dir=str(props_dir), stamps_dir=str(tmp_path / 'stamps'))
+
+
+def test_second_run_reruns_no_stages(preprocess_all):
+    cards = [make_card(i) for i in range(20)]
+    stages = [stage.name for stage in preprocessing.preprocessing_stages(cards)]
+    assert sorted(preprocess_all(cards)) == sorted(stages)
+    assert preprocess_all(cards) == []
+    # card.get_cards() is a set, which comes in another order in every process
+    assert preprocess_all(list(reversed(cards))) == []
+
+
+def test_changed_prop_reruns_its_stages(preprocess_all):
+    cards = [make_card(i) for i in range(20)]
+    preprocess_all(cards)
+    cards[3].card_faces[0].power = '9'
+    assert preprocess_all(cards) == ['power', 'prop_store']
+
+
+def test_changed_text_reruns_text_stages(preprocess_all):
+    cards = [make_card(i) for i in range(20)]
+    preprocess_all(cards)
+    cards[3].card_faces[0].rules_text = 'Flying'
+    assert preprocess_all(cards) == ['text', 'split']